@@ -0,0 +1,101 @@
+from dnvmodtodwc import reverse_occurrence_pivot, build_station_index, add_uuids, set_taxonomy_data, create_event_sheet, set_location_data, get_event_and_occurrence
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+import synthetic
+
+BASELINE = 'benchmark_baseline.json'
+
+def stages(pivot_data, stations_report, current_sea='Ekofisk', id_strategy='random'): # (name, setup, run) for each step of get_event_and_occurrence, setup copies what run changes
+    occurrence = reverse_occurrence_pivot(pivot_data)
+    station_index = build_station_index(occurrence['Station'].cat.categories)
+    add_uuids(occurrence, station_index, id_strategy, current_sea)
+    taxonomy = occurrence.copy()
+    set_taxonomy_data(taxonomy)
+    event = create_event_sheet(station_index, stations_report)
+    return [
+        ('reverse_occurrence_pivot', lambda: (pivot_data,), reverse_occurrence_pivot),
+        ('build_station_index', lambda: (occurrence['Station'].cat.categories,), build_station_index),
+        ('add_uuids', lambda: (occurrence.copy(), station_index.copy(), id_strategy, current_sea), add_uuids),
+        ('set_taxonomy_data', lambda: (occurrence.copy(),), set_taxonomy_data),
+        ('create_event_sheet', lambda: (station_index, stations_report), create_event_sheet),
+        ('set_location_data', lambda: (event.copy(), current_sea), set_location_data),
+        ('get_event_and_occurrence', lambda: (pivot_data, stations_report, current_sea, None, id_strategy), get_event_and_occurrence),
+    ]
+
+def measure(setup, run, repeat=3): # Best wall time of repeat runs, and the peak traced memory of one more run
+    times = []
+    for i in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - start)
+    args = setup()
+    tracemalloc.start()
+    try:
+        run(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(times), 'peak_bytes': peak}
+
+def run_benchmark(parameters, repeat=3):
+    pivot_data = synthetic.make_biology_report(parameters['species'], parameters['stations'], parameters['grabs'], range(parameters['first_year'], parameters['first_year'] + parameters['years']), parameters['density'], parameters['seed'])
+    stations_report = synthetic.make_stations_report(parameters['stations'], parameters['utm_only'], seed=parameters['seed'])
+    return {name: measure(setup, run, repeat) for name, setup, run in stages(pivot_data, stations_report, id_strategy=parameters['ids'])}
+
+def compare(results, baseline, tolerance): # Stages that got slower or use more memory than the baseline allows
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ('seconds', 'peak_bytes'):
+            if result[metric] > baseline[name][metric] * (1 + tolerance):
+                regressions.append((name, metric, baseline[name][metric], result[metric]))
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Time each conversion stage on a synthetic MOD export')
+    parser.add_argument('--species', type=int, default=500)
+    parser.add_argument('--stations', type=int, default=60)
+    parser.add_argument('--grabs', type=int, default=5)
+    parser.add_argument('--years', type=int, default=8)
+    parser.add_argument('--first-year', type=int, default=2006)
+    parser.add_argument('--density', type=float, default=0.05, help='share of species x station cells with a count (default: %(default)s)')
+    parser.add_argument('--utm-only', type=float, default=0.3, help='share of stations without WGS84 coordinates (default: %(default)s)')
+    parser.add_argument('--ids', choices=['random', 'uuid5'], default='random')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=BASELINE, help='results to compare against (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown or memory growth before a stage counts as a regression (default: %(default)s)')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    parameters = {name: getattr(args, name) for name in ('species', 'stations', 'grabs', 'years', 'first_year', 'density', 'utm_only', 'ids', 'seed')}
+    results = run_benchmark(parameters, args.repeat)
+    for name, result in results.items():
+        print('{:<26} {:>9.3f} s {:>9.1f} MB'.format(name, result['seconds'], result['peak_bytes'] / 1e6))
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'parameters': parameters, 'results': results}, f, indent=2)
+        return
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print('No baseline in ' + args.baseline + ', run with --save-baseline to create one')
+        return
+    if baseline['parameters'] != parameters:
+        print('Baseline was recorded with different parameters: ' + json.dumps(baseline['parameters']))
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for name, metric, before, after in regressions:
+        print('Regression in {}: {} went from {:.4g} to {:.4g}'.format(name, metric, before, after))
+    if regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+from datetime import datetime
+import json
+import numpy as np
+import os
+import pandas as pd
+
+EVENT_KEYS = {'id': ['eventID'], 'natural': ['waterBody', 'year', 'Station', 'eventRemarks']} # natural is the sea and station column header, '2008 R10-1 1' is year 2008, station R10-1, grab 1. Seas can share station codes
+OCCURRENCE_KEYS = {'id': ['occurrenceID'], 'natural': ['waterBody', 'year', 'Station', 'eventRemarks', 'scientificName']}
+ID_COLUMNS = ['eventID', 'occurrenceID'] # Not compared when records are matched on the natural key, random IDs differ every run
+
+def read_published(paths): # Everything as strings, so values compare the way they were written
+    frames = [pd.read_csv(path, dtype='str', keep_default_na=False) for path in paths]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(dtype='str')
+
+def published_paths(directory, years): # Only the files of the same --years, DIRECTORY may also hold the output of runs for other years
+    paths = [os.path.join(directory, 'dnv-' + name + '-' + years + '.csv') for name in ('events', 'occurrences')]
+    return [[path] if os.path.exists(path) else [] for path in paths]
+
+def add_event_keys(occurrences, events): # Occurrences only carry eventID, their natural key comes from the event they belong to
+    event_keys = events.reindex(columns=['eventID'] + EVENT_KEYS['natural']).drop_duplicates('eventID').set_index('eventID')
+    keyed = occurrences.copy()
+    keyed[EVENT_KEYS['natural']] = event_keys.reindex(occurrences.reindex(columns=['eventID'])['eventID']).to_numpy()
+    return keyed
+
+def without_seas(events, occurrences, seas): # Records of seas that failed this run are missing from the new output, they must not be published as removed
+    if not len(seas) or 'waterBody' not in events:
+        return events, occurrences
+    events = events[~events['waterBody'].isin(seas)]
+    return events, occurrences[occurrences['eventID'].isin(events['eventID'])]
+
+def fingerprint(frame, key_columns, value_columns): # One 64 bit hash of the key and one of the values for each row
+    keys = frame.reindex(columns=key_columns, fill_value='')
+    keys['repeat'] = keys.groupby(key_columns, sort=False).cumcount() # Keeps keys unique if a record key occurs twice
+    values = frame.reindex(columns=value_columns, fill_value='')
+    value_hashes = pd.util.hash_pandas_object(values, index=False).to_numpy() if value_columns else np.zeros(len(frame), dtype='uint64') # Nothing can change when every column is part of the key
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy(), value_hashes
+
+def compare(previous, current, key_columns, ignore_columns=()): # Returns the added, changed and removed rows, matched on the hashes of key_columns
+    value_columns = [column for column in current.columns if column not in key_columns and column not in ignore_columns]
+    previous_keys, previous_values = fingerprint(previous, key_columns, value_columns)
+    current_keys, current_values = fingerprint(current, key_columns, value_columns)
+    positions = pd.Index(previous_keys).get_indexer(current_keys)
+    matched = positions >= 0
+    changed = matched.copy()
+    changed[matched] = current_values[matched] != previous_values[positions[matched]]
+    removed = pd.Index(current_keys).get_indexer(previous_keys) < 0
+    return current[~matched], current[changed], previous[removed]
+
+def publish_delta(previous_events, previous_occurrences, current_events, current_occurrences, key='id', directory='result_files/delta', failed_seas=(), **details): # Writes the added, changed and removed rows and a manifest
+    columns = {'events': list(current_events.columns), 'occurrences': list(current_occurrences.columns)}
+    previous_events, previous_occurrences = without_seas(previous_events, previous_occurrences, failed_seas)
+    ignore_columns = ID_COLUMNS if key == 'natural' else []
+    if key == 'natural':
+        previous_occurrences = add_event_keys(previous_occurrences, previous_events)
+        current_occurrences = add_event_keys(current_occurrences, current_events)
+    os.makedirs(directory, exist_ok=True)
+    manifest = dict(details, generated=datetime.now().isoformat(), key=key, failed_seas=list(failed_seas))
+    for name, previous, current, keys in (('events', previous_events, current_events, EVENT_KEYS[key]), ('occurrences', previous_occurrences, current_occurrences, OCCURRENCE_KEYS[key])):
+        manifest[name] = {'previous': len(previous), 'current': len(current)}
+        for change, rows in zip(('added', 'changed', 'removed'), compare(previous, current, keys, ignore_columns)):
+            path = os.path.join(directory, 'dnv-' + name + '-' + change + '.csv')
+            rows.reindex(columns=columns[name]).to_csv(path, index=False)
+            manifest[name][change] = len(rows)
+            manifest[name][change + '_file'] = path
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
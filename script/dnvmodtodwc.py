@@ -1,57 +1,138 @@
+from functools import lru_cache
+from instrumentation import NULL_RECORDER
+import json
+import numpy as np
+import os
 import pandas as pd
 import uuid
-from pyproj import Proj, transform
-
-def get_event_and_occurrence(pivot_data, stations_report, current_sea): # Wrapper for other methods
-    occurrence = reverse_occurrence_pivot(pivot_data)
-    add_uuids(occurrence)
-    set_taxonomy_data(occurrence)
-    event = create_event_sheet(occurrence, stations_report)
-    set_location_data(event, current_sea)
+from pyproj import Transformer
+
+TAXONOMY_OVERRIDES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'taxonomy_overrides.json')
+ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'https://github.com/gbif-norway/data-processing-dnv-gl')
+
+def get_event_and_occurrence(pivot_data, stations_report, current_sea, years=None, id_strategy='random', recorder=NULL_RECORDER): # Wrapper for other methods
+    with recorder.stage('reverse_occurrence_pivot', current_sea, len(pivot_data)) as record:
+        occurrence = reverse_occurrence_pivot(pivot_data, years)
+        record['rows_out'] = len(occurrence)
+    with recorder.stage('build_station_index', current_sea, len(occurrence['Station'].cat.categories)) as record:
+        station_index = build_station_index(occurrence['Station'].cat.categories)
+        record['rows_out'] = len(station_index)
+    with recorder.stage('add_uuids', current_sea, len(occurrence)) as record:
+        add_uuids(occurrence, station_index, id_strategy, current_sea)
+        record['rows_out'] = len(occurrence)
+    with recorder.stage('set_taxonomy_data', current_sea, len(occurrence)) as record:
+        set_taxonomy_data(occurrence)
+        record['rows_out'] = len(occurrence)
+    with recorder.stage('create_event_sheet', current_sea, len(station_index)) as record:
+        event = create_event_sheet(station_index, stations_report)
+        record['rows_out'] = len(event)
+    with recorder.stage('set_location_data', current_sea, len(event)) as record:
+        set_location_data(event, current_sea)
+        record['rows_out'] = len(event)
     return event, occurrence
 
-def reverse_occurrence_pivot(pivot_data): # Changes data to 1 record per row, not a grid
-    occurrence = pd.melt(pivot_data, id_vars=('Species', 'Family'), var_name='Station', value_name='individualCount')
-    occurrence.dropna(inplace=True, subset=['individualCount'])
-    occurrence['individualCount'] = occurrence['individualCount'].astype(int)
-    return occurrence[occurrence['individualCount'] > 0]
+def reverse_occurrence_pivot(pivot_data, years=None): # Changes data to 1 record per row, not a grid
+    station_columns = select_station_columns(pivot_data.columns, years)
+    counts = pivot_data[station_columns].to_numpy(dtype=float, na_value=np.nan)
+    # Only the cells with a count are extracted, column by column like pd.melt. Counts are truncated to whole individuals, so anything below 1 is no record
+    station_codes, species_rows = np.nonzero((counts >= 1).T)
+    species = pd.Categorical(pivot_data['Species'])
+    family = pd.Categorical(pivot_data['Family'])
+    return pd.DataFrame({
+        'Species': pd.Categorical.from_codes(species.codes[species_rows], species.categories),
+        'Family': pd.Categorical.from_codes(family.codes[species_rows], family.categories),
+        'Station': pd.Categorical.from_codes(station_codes, station_columns).remove_unused_categories(),
+        'individualCount': counts[species_rows, station_codes].astype('int32')
+    })
+
+def select_station_columns(columns, years=None): # Station columns are named '<year> <station> <grab>', e.g. '2008 R10-1 1'
+    station_columns = [column for column in columns if column not in ('Species', 'Family')]
+    if years is None:
+        return station_columns
+    years = normalise_years(years)
+    return [column for column in station_columns if str(column).split(' ')[0] in years]
+
+def normalise_years(years): # Accepts a single year, or any iterable of years such as range(2018, 2021)
+    if isinstance(years, (int, str)):
+        years = [years]
+    return {str(year) for year in years}
+
+def build_station_index(station_headers): # One row per station column header, e.g. '2008 R10-1 1' is year 2008, station R10-1, grab 1
+    years, stations, grabs = [], [], []
+    for header in station_headers:
+        year, _, rest = str(header).partition(' ')
+        station, _, grab = rest.rpartition(' ')
+        years.append(year)
+        stations.append(station)
+        grabs.append(grab)
+    return pd.DataFrame({'header': list(station_headers), 'year': years, 'Station': stations, 'grab': grabs}, dtype=object)
+
+def add_uuids(occurrence, station_index=None, id_strategy='random', current_sea=''): # occurrence['Station'] codes are row positions in station_index, which gets the eventIDs
+    if station_index is None:
+        occurrence['Station'] = occurrence['Station'].astype('category')
+        station_index = build_station_index(occurrence['Station'].cat.categories)
+    generate_ids = ID_STRATEGIES.get(id_strategy, id_strategy)
+    event_names = (current_sea + '|' + station_index['header'].astype(str)).to_numpy(dtype=object)
+    station_codes = occurrence['Station'].cat.codes.to_numpy()
+    species = occurrence['Species'].astype(str).to_numpy(dtype=object)
+    repeats = occurrence.groupby([station_codes, species], sort=False).cumcount().to_numpy() # Tells apart a species listed twice in one pivot
+    occurrence_names = event_names[station_codes] + '|' + species
+    occurrence_names[repeats > 0] += '|' + repeats[repeats > 0].astype(str).astype(object)
+    occurrence['occurrenceID'] = generate_ids(occurrence_names)
+    station_index['eventID'] = generate_ids(event_names)
+    occurrence['eventID'] = station_index['eventID'].to_numpy()[station_codes]
 
-def add_uuids(occurrence):
-    occurrence['occurrenceID'] = [uuid.uuid4() for x in range(len(occurrence.index))]
-    occurrence['eventID'] = occurrence.groupby('Station')['Station'].transform(lambda x: uuid.uuid4())
+def random_ids(names): # uuid4s, with the random bytes for all of them drawn at once
+    random_bytes = np.frombuffer(os.urandom(16 * len(names)), dtype=np.uint8).reshape(-1, 16).copy()
+    random_bytes[:, 6] = (random_bytes[:, 6] & 0x0f) | 0x40 # Version 4
+    random_bytes[:, 8] = (random_bytes[:, 8] & 0x3f) | 0x80 # RFC 4122 variant
+    raw = random_bytes.tobytes()
+    return [uuid.UUID(bytes=raw[i:i + 16]) for i in range(0, len(raw), 16)]
 
-def set_taxonomy_data(occurrence):
+def name_based_ids(names): # uuid5s, the same names give the same IDs in every run
+    return [uuid.uuid5(ID_NAMESPACE, name) for name in names]
+
+ID_STRATEGIES = {'random': random_ids, 'uuid5': name_based_ids} # id_strategy can also be any function from a list of names to a list of IDs
+
+def set_taxonomy_data(occurrence, overrides_path=TAXONOMY_OVERRIDES):
     occurrence['basisOfRecord'] = 'MaterialSample'
     occurrence.rename(columns={'Species': 'scientificName', 'Family': 'family'}, inplace=True)
-    occurrence['phylum'] = ''
-    occurrence['class']  = ''
-    occurrence['order'] = ''
-
-    overrides_phylum = {'Crustacea': 'Arthropoda', 'Crustacea juv.': 'Arthropoda', 'Graptolithoidea': 'Hemichordata'}
-    overrides_class = {'Aplacophora': 'Caudofoveata', 'Cirripedia': 'Hexanauplia', 'Copepoda': 'Hexanauplia', 'Hexacorallia': 'Anthozoa', 'Hirudinea': 'Clitellata', 'Hydroidolina': 'Hydrozoa', 'Lepadomorpha': 'Hexanauplia', 'Oligochaeta': 'Clitellata', 'Oligochaeta juv.': 'Clitellata', 'Tectibranchiata': 'Gastropoda', 'Tellinoidea': 'Cardiida', 'Thoracica': 'Hexanauplia'}
-    overrides_order = {'Aeolidioidea': 'Nudibranchia', 'Amphitrite': 'Terebellida', 'Anomura': 'Decapoda', 'Anthuroidea': 'Isopoda', 'Asellota': 'Isopoda', 'Brachyura': 'Decapoda', 'Brachyura juv.': 'Decapoda', 'Caprelloidea': 'Amphipoda', 'Caridea': 'Decapoda', 'Caridea juv.': 'Decapoda', 'Echinidea': 'Camarodonta', 'Echinidea juv.': 'Camarodonta', 'Echiura': 'Echiuroidea', 'Echiurida': 'Echiuroidea', 'Gymnosomata': 'Pteropoda', 'Hyperiidea': 'Amphipoda', 'Pectinoidea': 'Pectinida', 'Pectinoidea juv.': 'Pectinida', 'Terebellomorpha': 'Terebellida', 'Terebellomorpha juv.': 'Terebellida', 'Veneroidea': 'Venerida'}
-    overrides_name = {'Amphitrite': 'Amphitrite Müller, 1771', 'Brachyura juv.': 'Brachyura', 'Caridea juv.': 'Caridea', 'Cirripedia': 'Cirripedia Burmeister, 1834', 'Copepoda': 'Copepoda Milne Edwards, 1840', 'Crustacea': 'Crustacea Brünnich, 1772', 'Crustacea juv.': 'Crustacea Brünnich, 1772', 'Cymothoida': 'Cymothoidae', 'Echinidea': 'Echinidea Kroh & Smith, 2010', 'Echinidea juv.': 'Echinidea Kroh & Smith, 2010', 'Echiurida': 'Echiuridae Quatrefages, 1847', 'Eunereis elittoralis': 'Eunereis elitoralis (Eliason, 1962)', 'Graptolithoidea': 'Graptolithoidea Beklemishev, 1951', 'Gymnosomata': 'Gymnosomata Blainville, 1824', 'Hexacorallia': 'Hexacorallia Haeckel, 1896', 'Hirudinea': 'Hirudinea Savigny, 1822', 'Hydroidolina': 'Hydroidolina Collins, 2000', 'Hyperiidea': 'Hyperiidea H. Milne Edwards, 1830', 'Lepadomorpha': 'Lepadomorpha Pilsbry, 1916', 'Opisthobranchia': 'Opisthobranchia', 'Pectinoidea': 'Pectinoidea Rafinesque, 1815', 'Pectinoidea juv.': 'Pectinoidea Rafinesque, 1815', 'Prosobranchia': 'Prosobranchia', 'Prosobranchia juv.': 'Prosobranchia', 'Tellinoidea': 'Tellinoidea Blainville, 1814', 'Terebellomorpha': 'Terebellomorpha Hatschek, 1893', 'Terebellomorpha juv.': 'Terebellomorpha Hatschek, 1893', 'Thoracica': 'Thoracica Darwin, 1854', 'Tunicata': 'Tunicata Lamarck, 1816', 'Veneroidea': 'Veneroidea Rafinesque, 1815'}
-    overrides_name['Archiannelida'] = 'Polychaeta'
-    overrides_name['Doridae'] = 'Dorididae'
-    overrides_name['Gammaridea'] = 'Amphipoda'
-    overrides_name['Opisthobranchia'] = 'Heterobranchia'
-    overrides_name['Prosobranchia'] = 'Gastropoda'
-    occurrence.loc[occurrence['scientificName'].isin(overrides_phylum.keys()), 'phylum'] = occurrence.loc[occurrence['scientificName'].isin(overrides_phylum.keys()), 'scientificName'].replace(overrides_phylum)
-    occurrence.loc[occurrence['scientificName'].isin(overrides_class.keys()), 'class'] = occurrence.loc[occurrence['scientificName'].isin(overrides_class.keys()), 'scientificName'].replace(overrides_class)
-    occurrence.loc[occurrence['scientificName'].isin(overrides_order.keys()), 'order'] = occurrence.loc[occurrence['scientificName'].isin(overrides_order.keys()), 'scientificName'].replace(overrides_order)
-    occurrence.loc[occurrence['scientificName'].isin(overrides_name.keys()), 'scientificName'] = occurrence.loc[occurrence['scientificName'].isin(overrides_name.keys()), 'scientificName'].replace(overrides_name)
-    occurrence.loc[occurrence['scientificName'] == 'Grania', 'family'] = 'Enchytraeidae'
-
-def create_event_sheet(occurrence, stations_report):
-    station_years = occurrence['Station'].str.split(' ', expand=True)
+    names = occurrence['scientificName'].astype('category')
+    resolved = compile_taxonomy_overrides(overrides_path).reindex(names.cat.categories) # Resolved once per distinct name
+    for rank in ('phylum', 'class', 'order'):
+        occurrence[rank] = broadcast(names, resolved[rank].fillna(''))
+    occurrence['scientificName'] = broadcast(names, resolved['scientificName'].fillna(pd.Series(names.cat.categories, index=names.cat.categories)))
+    family_override = broadcast(names, resolved['family'])
+    overridden = family_override.notna().to_numpy()
+    if overridden.any():
+        family = occurrence['family'].astype('category') if 'family' in occurrence else pd.Series(pd.Categorical([None] * len(occurrence)), index=occurrence.index)
+        family = family.cat.set_categories(family.cat.categories.union(family_override.cat.categories))
+        family[overridden] = family_override[overridden].astype(object).to_numpy()
+        occurrence['family'] = family
+
+@lru_cache()
+def compile_taxonomy_overrides(overrides_path=TAXONOMY_OVERRIDES): # One row per overridden Species name, with every rank resolved
+    with open(overrides_path, encoding='utf-8') as f:
+        overrides = json.load(f)
+    names = sorted(set().union(*(overrides[column] for column in ('phylum', 'class', 'order', 'scientificName', 'family'))))
+    table = pd.DataFrame({rank: [overrides[rank].get(name, '') for name in names] for rank in ('phylum', 'class', 'order')}, index=names, dtype=object)
+    table['scientificName'] = [overrides['scientificName'].get(name, name) for name in names]
+    table['family'] = [overrides['family'].get(scientific_name) for scientific_name in table['scientificName']]
+    return table
+
+def broadcast(categorical, values): # Spreads one value per category out to the rows through the category codes, the result is categorical
+    mapped = pd.Categorical(values)
+    codes = np.append(mapped.codes, -1)[categorical.cat.codes] # Missing values have code -1, which picks the appended -1
+    return pd.Series(pd.Categorical.from_codes(codes, mapped.categories), index=categorical.index)
+
+def create_event_sheet(station_index, stations_report):
     event = pd.DataFrame({
-        'eventID': occurrence['eventID'],
-        'Station': station_years[1],
-        'eventRemarks': 'grab ' + station_years[2],
-        'year': station_years[0],
-        'eventDate': station_years[0] + '-05/' + station_years[0] + '-06'
+        'eventID': station_index['eventID'],
+        'Station': station_index['Station'],
+        'eventRemarks': 'grab ' + station_index['grab'],
+        'year': station_index['year'],
+        'eventDate': station_index['year'] + '-05/' + station_index['year'] + '-06'
     })
-    event.drop_duplicates(inplace=True)
     event = pd.merge(event, stations_report, how='left', on='Station')
     return event
 
@@ -62,23 +143,53 @@ def set_location_data(event, current_sea):
     event['locationRemarks'] = event['locationRemarks'].str.replace(', direction from station: nan, distance from station: nan', '')
     event['locationRemarks'] = event['locationRemarks'].str.replace(', direction from station: None, distance from station: None', '')
     event['maximumDepthInMeters'] = event['Depth']
-    event.drop(columns=['Distance', 'Direction', 'UTM31E', 'UTM31N', 'UTM32E', 'UTM32N', 'UTM34E', 'UTM34N', 'UTM35E', 'UTM35N', 'UTM36E', 'UTM36N', 'ED50E', 'ED50N'], inplace=True)
+    event['UTM33E'], event['UTM33N'], verbatim_srs = select_verbatim_coordinates(event, current_sea) # Keeps the position of the UTM33 columns for the verbatim coordinates
+    event.drop(columns=['Distance', 'Direction'] + [column for easting, northing, crs in PROJECTED_COORDINATES[1:] for column in (easting, northing)], inplace=True, errors='ignore')
 
-    event['verbatimCoordinateSystem'] = 'UTM'
-    event['verbatimSrS'] = 'EPSG:32633'
+    event['verbatimCoordinateSystem'] = verbatim_srs.where(verbatim_srs.isnull(), 'UTM')
+    event['verbatimSrS'] = verbatim_srs
     event.rename(columns={'Installation': 'locality', 'Depth': 'minimumDepthInMeters', 'WGS84E': 'decimalLongitude', 'WGS84N': 'decimalLatitude', 'UTM33E': 'verbatimLongitude', 'UTM33N': 'verbatimLatitude'}, inplace=True)
     convert_utm_coordinates(event)
 
-def convert_utm_coordinates(event):
-    utm_records = pd.isnull(event['decimalLatitude'])
-    if not len(event[utm_records]):
-        return
-    #inProj, outProj = Proj('epsg:32633'), Proj('epsg:4326')
-    inProj, outProj = Proj(proj='utm', zone=33, ellps='WGS84'), Proj('epsg:4326')
-    verbatim_lat = event.loc[utm_records, 'verbatimLatitude']
-    verbatim_long = event.loc[utm_records, 'verbatimLongitude']
-    event.loc[utm_records, 'geodeticDatum'] = 'EPSG:32633'
-    event.loc[utm_records, 'decimalLatitude'], event.loc[utm_records, 'decimalLongitude'] = transform(inProj, outProj, verbatim_long.tolist(), verbatim_lat.tolist())
-    #event.loc[utm_records, 'decimalLongitude'] = event.loc[utm_records, 'decimalLongitude'].transform(lambda x: round(x, 5))
-    #event.loc[utm_records, 'decimalLatitude'] = event.loc[utm_records, 'decimalLatitude'].transform(lambda x: round(x, 5))
+PROJECTED_COORDINATES = [ # Easting and northing columns of the stations report, in order of preference for the verbatim coordinates
+    ('UTM33E', 'UTM33N', 'EPSG:32633'),
+    ('UTM31E', 'UTM31N', 'EPSG:32631'),
+    ('UTM32E', 'UTM32N', 'EPSG:32632'),
+    ('UTM34E', 'UTM34N', 'EPSG:32634'),
+    ('UTM35E', 'UTM35N', 'EPSG:32635'),
+    ('UTM36E', 'UTM36N', 'EPSG:32636'),
+    ('ED50E', 'ED50N', None), # ED50 / UTM, the zone depends on the sea, see ED50_ZONES
+]
+ED50_ZONES = {current_sea: 'EPSG:23031' for current_sea in ('Ekofisk', 'Oseberg', 'Sleipner', 'Statfjord1', 'Statfjord2')} # ED50 / UTM zone 31N, the North Sea fields between 0 and 6 degrees east
+UNKNOWN_ED50_ZONE = 'ED50' # ED50 pairs of the other seas are kept as verbatim coordinates but not converted, guessing the zone would put them hundreds of kilometres off
+
+def select_verbatim_coordinates(event, current_sea=''): # The first populated coordinate pair of each station, and its CRS
+    easting = pd.Series(np.nan, index=event.index)
+    northing = pd.Series(np.nan, index=event.index)
+    srs = pd.Series(None, index=event.index, dtype=object)
+    for easting_column, northing_column, crs in PROJECTED_COORDINATES:
+        if easting_column not in event or northing_column not in event:
+            continue
+        pair_easting = pd.to_numeric(event[easting_column], errors='coerce')
+        pair_northing = pd.to_numeric(event[northing_column], errors='coerce')
+        populated = srs.isnull() & pair_easting.notna() & pair_northing.notna()
+        easting[populated] = pair_easting[populated]
+        northing[populated] = pair_northing[populated]
+        srs[populated] = crs or ED50_ZONES.get(current_sea, UNKNOWN_ED50_ZONE)
+    return easting, northing, srs
+
+def convert_utm_coordinates(event): # Converts each CRS group in one call, for the stations without WGS84 coordinates
+    missing = pd.isnull(event['decimalLatitude']) | pd.isnull(event['decimalLongitude'])
+    event.loc[missing, 'geodeticDatum'] = None # Only the stations that get converted have decimal coordinates, and those are WGS84 whatever the verbatimSrS
+    for crs in event.loc[missing, 'verbatimSrS'].dropna().unique():
+        if crs == UNKNOWN_ED50_ZONE:
+            continue
+        rows = (missing & (event['verbatimSrS'] == crs)).to_numpy()
+        longitude, latitude = get_transformer(crs).transform(event.loc[rows, 'verbatimLongitude'].to_numpy(dtype=float), event.loc[rows, 'verbatimLatitude'].to_numpy(dtype=float))
+        event.loc[rows, 'decimalLongitude'] = longitude
+        event.loc[rows, 'decimalLatitude'] = latitude
+        event.loc[rows, 'geodeticDatum'] = 'WGS84'
 
+@lru_cache()
+def get_transformer(crs):
+    return Transformer.from_crs(crs, 'EPSG:4326', always_xy=True)
@@ -0,0 +1,157 @@
+from datetime import date
+from excel_cache import write_atomically
+from queue import Queue
+from threading import Thread
+from xml.etree.ElementTree import Element, SubElement, register_namespace, tostring
+import zipfile
+import pandas as pd
+
+DWC = 'http://rs.tdwg.org/dwc/terms/'
+EML = 'eml://ecoinformatics.org/eml-2.1.1'
+DWC_TERMS = ['eventID', 'eventDate', 'eventRemarks', 'year', 'locality', 'waterBody', 'locationRemarks', 'minimumDepthInMeters', 'maximumDepthInMeters',
+             'decimalLatitude', 'decimalLongitude', 'geodeticDatum', 'verbatimLatitude', 'verbatimLongitude', 'verbatimCoordinateSystem',
+             'occurrenceID', 'basisOfRecord', 'individualCount', 'scientificName', 'scientificNameID', 'phylum', 'class', 'order', 'family']
+TERMS = dict({term: DWC + term for term in DWC_TERMS}, verbatimSrS=DWC + 'verbatimSRS') # Columns that are not Darwin Core terms, such as Station, stay in the files unmapped
+CHUNKSIZE = 50000
+QUEUE_SIZE = 8 # Formatted chunks waiting for the writer thread, bounds the memory of the pipeline
+
+register_namespace('eml', EML)
+
+def write_archive(path, events, occurrences, chunksize=CHUNKSIZE, compresslevel=6, copies=(None, None), **metadata): # Event core and occurrence extension written chunk by chunk from the per sea frames, no concatenated copy is made. copies are optional paths for CSV copies of event.txt and occurrence.txt
+    events, occurrences = list(events), list(occurrences)
+    event_columns, occurrence_columns = union_columns(events), union_columns(occurrences)
+    event_chunks, occurrence_chunks = table_chunks(events, event_columns, chunksize), table_chunks(occurrences, occurrence_columns, chunksize)
+    entries = [
+        ('event.txt', copy_chunks(event_chunks, copies[0]) if copies[0] else event_chunks),
+        ('occurrence.txt', copy_chunks(occurrence_chunks, copies[1]) if copies[1] else occurrence_chunks),
+        ('meta.xml', [meta_xml(event_columns, occurrence_columns)]),
+        ('eml.xml', [eml_xml(**metadata)]),
+    ]
+    write_atomically(path, lambda temporary: stream_archive(temporary, entries, compresslevel))
+    return path
+
+def write_csv(path, frames, chunksize=CHUNKSIZE, sep=','): # Same output as pd.concat(frames).to_csv(path, index=False), without the concatenated copy
+    frames = list(frames)
+    with open(path, 'wb') as f:
+        for chunk in table_chunks(frames, union_columns(frames), chunksize, sep):
+            f.write(chunk)
+    return path
+
+def copy_chunks(chunks, path): # Writes each chunk to path as it is passed on, so the rows are formatted once for both the file and the archive
+    with open(path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+            yield chunk
+
+def union_columns(frames): # Columns in the order pd.concat would give them
+    columns = []
+    for frame in frames:
+        columns += [column for column in frame.columns if column not in columns]
+    return columns
+
+def common_dtypes(frames, columns): # The dtype pd.concat would give each column, found by concatenating no rows. A frame without the column adds missing values
+    return {column: pd.concat([frame[column].iloc[:0] if column in frame else pd.Series(dtype=float) for frame in frames]).dtype for column in columns}
+
+def table_chunks(frames, columns, chunksize=CHUNKSIZE, sep=','): # The header, then chunksize rows at a time, as UTF-8 bytes
+    dtypes = common_dtypes(frames, columns) # Formatted like the concatenated table, e.g. depths are 345.0 in every sea once one sea has a missing depth
+    yield pd.DataFrame(columns=columns).to_csv(sep=sep, index=False).encode('utf-8')
+    for frame in frames:
+        casts = {column: dtype for column, dtype in dtypes.items() if column not in frame or frame[column].dtype != dtype}
+        for start in range(0, len(frame), chunksize):
+            chunk = frame.iloc[start:start + chunksize].reindex(columns=columns).astype(casts)
+            yield chunk.to_csv(sep=sep, index=False, header=False).encode('utf-8')
+
+def stream_archive(path, entries, compresslevel=6): # Chunks are formatted here and deflated in a writer thread, zlib releases the GIL while it compresses
+    chunks = Queue(maxsize=QUEUE_SIZE)
+    errors = []
+    writer = Thread(target=write_entries, args=(path, chunks, compresslevel, errors), daemon=True)
+    writer.start()
+    try:
+        for name, entry_chunks in entries:
+            for chunk in entry_chunks:
+                if errors:
+                    break
+                chunks.put((name, chunk))
+            chunks.put((name, None)) # Closes the entry
+    finally:
+        chunks.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+
+def write_entries(path, chunks, compresslevel, errors): # Zip entries have to be written one after the other, chunks of the next entry wait in the queue
+    finished = False
+    try:
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as archive:
+            entry = None
+            try:
+                while not finished:
+                    item = chunks.get()
+                    finished = item is None
+                    if finished:
+                        break
+                    name, chunk = item
+                    if entry is None:
+                        entry = archive.open(name, 'w', force_zip64=True) # The size is not known up front
+                    if chunk is None:
+                        entry.close()
+                        entry = None
+                    else:
+                        entry.write(chunk)
+            finally:
+                if entry is not None: # The producer failed half way through an entry
+                    entry.close()
+    except Exception as e:
+        errors.append(e)
+        while not finished and chunks.get() is not None: # Keeps taking chunks so the producer is never blocked on a full queue
+            pass
+
+def meta_xml(event_columns, occurrence_columns): # Describes event.txt as the core and occurrence.txt as an extension linked on eventID
+    archive = Element('archive', xmlns='http://rs.tdwg.org/dwc/text/', metadata='eml.xml')
+    add_file_element(archive, 'core', 'event.txt', DWC + 'Event', event_columns, 'id')
+    add_file_element(archive, 'extension', 'occurrence.txt', DWC + 'Occurrence', occurrence_columns, 'coreid')
+    return tostring(archive, encoding='utf-8', xml_declaration=True)
+
+def add_file_element(archive, tag, location, row_type, columns, id_tag):
+    element = SubElement(archive, tag, encoding='UTF-8', fieldsTerminatedBy=',', linesTerminatedBy='\\n', fieldsEnclosedBy='"', ignoreHeaderLines='1', rowType=row_type)
+    SubElement(SubElement(element, 'files'), 'location').text = location
+    SubElement(element, id_tag, index=str(columns.index('eventID')))
+    for index, column in enumerate(columns):
+        if column in TERMS:
+            SubElement(element, 'field', index=str(index), term=TERMS[column])
+
+def eml_xml(title='DNV GL MOD benthic fauna', abstract='Species abundance data from the MOD database', creator='DNV GL', publication_date=None, package_id=''): # The minimal dataset metadata, the IPT fills in the rest
+    eml = Element('{' + EML + '}eml', packageId=package_id, system='http://gbif.org', scope='system')
+    dataset = SubElement(eml, 'dataset')
+    SubElement(dataset, 'title').text = title
+    for role in ('creator', 'contact'):
+        SubElement(SubElement(dataset, role), 'organizationName').text = creator
+    SubElement(dataset, 'pubDate').text = (publication_date or date.today()).isoformat()
+    SubElement(SubElement(dataset, 'abstract'), 'para').text = abstract
+    return tostring(eml, encoding='utf-8', xml_declaration=True)
+
+def write_parquet(path, frames): # One row group per frame for analytics, needs pyarrow. Whole numbers stay integers when every frame has them, other non numeric columns are written as text
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    frames = list(frames)
+    columns = union_columns(frames)
+    schema = pa.schema([(column, parquet_type(pa, [frame[column].dtype if column in frame else None for frame in frames])) for column in columns])
+    write_atomically(path, lambda temporary: write_row_groups(pa, pq, temporary, frames, schema))
+    return path
+
+def parquet_type(pa, dtypes):
+    if all(dtype is not None and pd.api.types.is_integer_dtype(dtype) for dtype in dtypes):
+        return pa.int64()
+    if all(dtype is None or (pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)) for dtype in dtypes):
+        return pa.float64()
+    return pa.string()
+
+def write_row_groups(pa, pq, path, frames, schema):
+    with pq.ParquetWriter(path, schema) as writer:
+        for frame in frames:
+            frame = frame.reindex(columns=schema.names)
+            for field in schema:
+                if field.type == pa.string():
+                    values = frame[field.name].astype(object)
+                    frame[field.name] = values.where(values.notna(), None).map(str, na_action='ignore') # eventIDs are uuid.UUID objects
+            writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
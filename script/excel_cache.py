@@ -0,0 +1,84 @@
+import hashlib
+import numpy as np
+import os
+import pandas as pd
+
+CACHE_DIR = 'cache'
+SEPARATOR = '--' # Cache entries are named <workbook>--<content hash>--<sheet>.<parquet|pkl>
+
+def read_sheet(path, sheet_name, cache_dir=CACHE_DIR): # Drop in replacement for pd.ExcelFile(path).parse(sheet_name)
+    digest = file_hash(path)
+    cached = find_entry(path, sheet_name, digest, cache_dir)
+    if cached:
+        return read_entry(cached)
+    data = pd.ExcelFile(path).parse(sheet_name)
+    write_entry(data, entry_path(path, sheet_name, digest, cache_dir))
+    return data
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def workbook_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+def entry_path(path, sheet_name, digest, cache_dir):
+    sheet = sheet_name.replace(os.sep, '_')
+    return os.path.join(cache_dir, SEPARATOR.join([workbook_name(path), digest, sheet]))
+
+def find_entry(path, sheet_name, digest, cache_dir):
+    base = entry_path(path, sheet_name, digest, cache_dir)
+    for extension in ('.parquet', '.pkl'):
+        if os.path.exists(base + extension):
+            return base + extension
+    return None
+
+def read_entry(cached):
+    if cached.endswith('.parquet'):
+        data = pd.read_parquet(cached)
+        for column in data.columns[data.dtypes == object]: # Missing text comes back from Parquet as None, parsing the workbook gives NaN
+            data[column] = data[column].where(data[column].notna(), np.nan)
+        return data
+    return pd.read_pickle(cached)
+
+def write_entry(data, base):
+    os.makedirs(os.path.dirname(base) or '.', exist_ok=True)
+    try: # Parquet needs pyarrow and a single type per column, Excel sheets do not always have that
+        write_atomically(base + '.parquet', data.to_parquet)
+    except (ImportError, ValueError, TypeError, NotImplementedError):
+        write_atomically(base + '.pkl', data.to_pickle)
+
+def write_atomically(destination, writer): # Several worker processes can parse the same sea, readers must never see a half written file
+    temporary = destination + '.' + str(os.getpid()) + '.tmp'
+    try:
+        writer(temporary)
+        os.replace(temporary, destination)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+def list_entries(cache_dir=CACHE_DIR):
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for name in os.listdir(cache_dir):
+        parts = os.path.splitext(name)[0].split(SEPARATOR)
+        if len(parts) == 3 and name.endswith(('.parquet', '.pkl')):
+            entries.append((parts[0], parts[1], os.path.join(cache_dir, name)))
+    return entries
+
+def invalidate(path, cache_dir=CACHE_DIR): # Removes every cached sheet of a workbook, whatever its content hash
+    removed = [cached for workbook, digest, cached in list_entries(cache_dir) if workbook == workbook_name(path)]
+    for cached in removed:
+        os.remove(cached)
+    return removed
+
+def prune(source_paths, cache_dir=CACHE_DIR): # Removes entries for workbooks that changed or are no longer among source_paths
+    current = {workbook_name(path): file_hash(path) for path in source_paths if os.path.exists(path)}
+    removed = [cached for workbook, digest, cached in list_entries(cache_dir) if current.get(workbook) != digest]
+    for cached in removed:
+        os.remove(cached)
+    return removed
@@ -0,0 +1,86 @@
+from contextlib import contextmanager
+import json
+import resource
+import sys
+import time
+import tracemalloc
+
+class Recorder: # Collects wall time, rows in and out and memory per stage, e.g. with recorder.stage('merge', rows_in=len(df)) as record: ... record['rows_out'] = ...
+    enabled = True
+
+    def __init__(self, trace_memory=False): # tracemalloc gives the peak Python allocations of each stage, but slows everything down
+        self.trace_memory = trace_memory
+        self.records = []
+        self.peaks = [] # Peak traced memory of the open stages, so nested stages do not hide each other's peaks
+
+    @contextmanager
+    def stage(self, name, sea=None, rows_in=None):
+        record = {'stage': name, 'sea': sea, 'rows_in': rows_in, 'rows_out': None}
+        tracing = self.trace_memory and self.start_tracing()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            record['max_rss_bytes'] = max_rss_bytes()
+            if tracing:
+                record['peak_traced_bytes'] = self.stop_tracing()
+            self.records.append(record)
+
+    def start_tracing(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], tracemalloc.get_traced_memory()[1])
+        if hasattr(tracemalloc, 'reset_peak'): # Python 3.9+, before that peaks are measured from the start of the outermost stage
+            tracemalloc.reset_peak()
+        self.peaks.append(0)
+        return True
+
+    def stop_tracing(self):
+        peak = max(self.peaks.pop(), tracemalloc.get_traced_memory()[1])
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], peak)
+        else:
+            tracemalloc.stop()
+        return peak
+
+    def extend(self, records): # Records from a worker process
+        self.records.extend(records)
+
+    def write(self, path, **details):
+        with open(path, 'w') as f:
+            json.dump(dict(details, stages=self.records), f, indent=2, default=str)
+
+class NullStage:
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc_info):
+        return False
+
+class NullRecorder: # Used when instrumentation is off, stage() only hands out a dict nobody reads
+    enabled = False
+    trace_memory = False
+    records = []
+
+    def stage(self, name, sea=None, rows_in=None):
+        return NULL_STAGE
+
+    def extend(self, records):
+        pass
+
+    def write(self, path, **details):
+        pass
+
+NULL_STAGE = NullStage()
+NULL_RECORDER = NullRecorder()
+
+def make_recorder(report=None): # report is None for no instrumentation, 'time' or 'memory' to also trace allocations
+    if not report:
+        return NULL_RECORDER
+    return Recorder(trace_memory=report == 'memory')
+
+def max_rss_bytes(): # High-water mark of the whole process, cheap enough to take after every stage
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
@@ -1,44 +1,145 @@
-from dnvmodtodwc import reverse_occurrence_pivot, add_uuids, create_event_sheet, set_taxonomy_data, set_location_data, get_event_and_occurrence
+from dnvmodtodwc import get_event_and_occurrence
+from instrumentation import NULL_RECORDER, make_recorder
+from datetime import datetime
+import delta
+import dwca
+import excel_cache
+import species_store
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import sys
+import traceback
 import pandas as pd
 
 seas = ['Barents Sea South', 'UK Shelf', 'Ekofisk', 'Finnmark', 'More', 'Nordland', 'Oseberg', 'Sleipner', 'Statfjord1', 'Statfjord2', 'Trondelag']
-occurrence_dfs = []
-event_dfs = []
-for current_sea in seas:
+
+def source_paths(current_sea):
     file_sea_name = current_sea.lower().replace(' ', '_')
+    return 'source_files/' + file_sea_name + '_stations.xlsx', 'source_files/' + file_sea_name + '.xlsx'
+
+def read_sheet(path, sheet_name, use_cache=True):
+    if use_cache:
+        return excel_cache.read_sheet(path, sheet_name)
+    return pd.ExcelFile(path).parse(sheet_name)
+
+def process_sea(current_sea, use_cache=True, years=None, id_strategy='uuid5', report=None): # Runs in a worker process, so it must stay a module level function
+    recorder = make_recorder(report)
+    stations_path, pivot_path = source_paths(current_sea)
+    with recorder.stage('read_stations_report', current_sea) as record:
+        stations_report = read_sheet(stations_path, 'Stations_Report.xlsx', use_cache)
+        record['rows_out'] = len(stations_report)
+    with recorder.stage('read_biology_report', current_sea) as record:
+        pivot_data = read_sheet(pivot_path, 'Biology_Report.xlsx', use_cache)
+        record['rows_out'] = len(pivot_data)
+    event, occurrence = get_event_and_occurrence(pivot_data, stations_report, current_sea, years, id_strategy, recorder)
+    return event, occurrence, recorder.records
+
+def process_seas(seas, workers=None, process=process_sea, recorder=NULL_RECORDER, **kwargs): # Results come back in the order of seas, a failing sea does not lose the others
+    results, failures = {}, {}
+    if workers == 1: # Run in this process, e.g. to be able to use pdb
+        for current_sea in seas:
+            try:
+                results[current_sea] = process(current_sea, **kwargs)
+            except Exception as e:
+                failures[current_sea] = format_failure(e)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [(current_sea, executor.submit(process, current_sea, **kwargs)) for current_sea in seas]
+            for current_sea, future in futures:
+                try:
+                    results[current_sea] = future.result()
+                except Exception as e:
+                    failures[current_sea] = format_failure(e)
+    event_dfs = [results[current_sea][0] for current_sea in seas if current_sea in results]
+    occurrence_dfs = [results[current_sea][1] for current_sea in seas if current_sea in results]
+    for current_sea in seas:
+        if current_sea in results:
+            recorder.extend(results[current_sea][2])
+    return event_dfs, occurrence_dfs, failures
+
+def format_failure(e):
+    return ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+
+def report_failures(failures):
+    for current_sea, failure in failures.items():
+        print('Processing ' + current_sea + ' failed:\n' + failure, file=sys.stderr)
+
+def write_unmatched(names, path='result_files/unmatched-names.txt'): # Names without an AphiaID, to be added to species_table.csv
+    pd.Series(sorted(set(names)), dtype=object).to_csv(path, index=False, header=False)
+
+def parse_years(years): # '2020' or an inclusive range such as '2018-2020'
+    first, _, last = years.partition('-')
+    return range(int(first), int(last or first) + 1)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Convert MOD exports in source_files/ to Darwin Core in result_files/')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes, defaults to the number of CPUs, 1 runs without a pool')
+    parser.add_argument('--years', default='2020', help='year or inclusive range of years to publish, e.g. 2020 or 2018-2020 (default: %(default)s)')
+    parser.add_argument('--ids', dest='id_strategy', choices=['uuid5', 'random'], default='uuid5', help='uuid5 derives occurrenceIDs and eventIDs from sea, station column and species so they are the same every run, random creates new ones (default: %(default)s)')
+    parser.add_argument('--chunksize', type=int, default=100000, help='rows of old-occurrence.txt to re-annotate, and of the output files to write, at a time (default: %(default)s)')
+    parser.add_argument('--parquet', action='store_true', help='also write the events and occurrences as Parquet files, needs pyarrow')
+    parser.add_argument('--report', choices=['time', 'memory'], help='write wall time, rows and memory of every stage to result_files/run-report.json, memory also traces the peak allocations of each stage, which is slower')
+    parser.add_argument('--delta-against', metavar='DIRECTORY', help='also write the events and occurrences added, changed or removed since the dnv-events-<years>.csv and dnv-occurrences-<years>.csv of the same --years published in DIRECTORY to result_files/delta/')
+    parser.add_argument('--delta-key', choices=['id', 'natural'], default='id', help='match records on occurrenceID/eventID, or on sea, station column header and scientificName when the IDs are random (default: %(default)s)')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false', help='always parse the Excel files instead of using the parsed copies in ' + excel_cache.CACHE_DIR + '/')
+    parser.add_argument('--clear-cache', action='store_true', help='remove all parsed copies before running')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    recorder = make_recorder(args.report)
+    started = datetime.now().isoformat()
+    all_source_paths = [path for current_sea in seas for path in source_paths(current_sea)]
+    if args.clear_cache:
+        for path in all_source_paths:
+            excel_cache.invalidate(path)
+    with recorder.stage('process_seas', rows_in=len(seas)) as record:
+        event_dfs, occurrence_dfs, failures = process_seas(seas, args.workers, recorder=recorder, use_cache=args.use_cache, years=parse_years(args.years), id_strategy=args.id_strategy, report=args.report)
+        record['rows_out'] = len(event_dfs)
+    report_failures(failures)
+    if args.use_cache:
+        with recorder.stage('prune_cache'):
+            excel_cache.prune(all_source_paths)
+    if not event_dfs: # The report is most needed when nothing could be processed
+        recorder.write('result_files/run-report.json', started=started, arguments=vars(args), failures=list(failures))
+        sys.exit('No seas could be processed')
+
+    with recorder.stage('scientific_name_ids', rows_in=sum(len(occurrence) for occurrence in occurrence_dfs)) as record:
+        species_store.build_store()
+        scientific_name_ids, unmatched = species_store.scientific_name_ids(set().union(*(occurrence['scientificName'].unique() for occurrence in occurrence_dfs)))
+        for occurrence in occurrence_dfs: # Each sea keeps its own frame, the outputs are written from them directly
+            del occurrence['Station']
+            occurrence['scientificNameID'] = occurrence['scientificName'].map(scientific_name_ids)
+        record['rows_out'] = sum(len(occurrence) for occurrence in occurrence_dfs)
+    event_dfs = [event.drop_duplicates() for event in event_dfs]
+
+    if args.delta_against: # Read before the new files are written, DIRECTORY may be result_files itself
+        with recorder.stage('load_previous') as record:
+            previous_event_paths, previous_occurrence_paths = delta.published_paths(args.delta_against, args.years)
+            previous_events, previous_occurrences = delta.read_published(previous_event_paths), delta.read_published(previous_occurrence_paths)
+            record['rows_out'] = len(previous_occurrences)
+
+    events_path, occurrences_path = 'result_files/dnv-events-' + args.years + '.csv', 'result_files/dnv-occurrences-' + args.years + '.csv'
+    event_rows, occurrence_rows = sum(len(event) for event in event_dfs), sum(len(occurrence) for occurrence in occurrence_dfs)
+    with recorder.stage('write_archive', rows_in=event_rows + occurrence_rows) as record: # The CSVs are copies of the archive entries, each row is formatted once
+        dwca.write_archive('result_files/dnv-dwca-' + args.years + '.zip', event_dfs, occurrence_dfs, args.chunksize, copies=(events_path, occurrences_path), title='DNV GL MOD benthic fauna ' + args.years)
+        record['rows_out'] = event_rows + occurrence_rows
+    if args.parquet:
+        with recorder.stage('write_parquet', rows_in=event_rows + occurrence_rows):
+            dwca.write_parquet('result_files/dnv-events-' + args.years + '.parquet', event_dfs)
+            dwca.write_parquet('result_files/dnv-occurrences-' + args.years + '.parquet', occurrence_dfs)
+
+    if args.delta_against:
+        with recorder.stage('delta', rows_in=occurrence_rows) as record:
+            current_events, current_occurrences = delta.read_published([events_path]), delta.read_published([occurrences_path]) # Compared as written
+            manifest = delta.publish_delta(previous_events, previous_occurrences, current_events, current_occurrences, args.delta_key,
+                                           previous_files=previous_event_paths + previous_occurrence_paths, current_files=[events_path, occurrences_path], failed_seas=list(failures))
+            record['rows_out'] = sum(manifest['occurrences'][change] for change in ('added', 'changed', 'removed'))
+
+    with recorder.stage('annotate_old_occurrences'):
+        old_unmatched = species_store.annotate_occurrence_file('source_files/old-occurrence.txt', 'result_files/dnv-occurrences-updatedwithaphia.txt', chunksize=args.chunksize)
+    write_unmatched(unmatched + old_unmatched)
+    recorder.write('result_files/run-report.json', started=started, arguments=vars(args), failures=list(failures))
 
-    stations_report = pd.ExcelFile('source_files/' + file_sea_name + '_stations.xlsx').parse('Stations_Report.xlsx')
-    pivot_data = pd.ExcelFile('source_files/' + file_sea_name + '.xlsx').parse('Biology_Report.xlsx')
-    event, occurrence = get_event_and_occurrence(pivot_data, stations_report, current_sea)
-    occurrence_dfs.append(occurrence)
-    event_dfs.append(event)
-    #event.to_csv('result_files/' + file_sea_name + '_event.csv')
-    #occurrence.to_csv('result_files/' + file_sea_name + '_occurrence.csv')
-
-events = pd.concat(event_dfs)
-occurrences = pd.concat(occurrence_dfs)
-del occurrences['Station']
-all = occurrences.merge(events, how='left', on=['eventID'])
-
-species = pd.read_csv('source_files/species_table.csv', dtype='str')
-species = species[species['Source'].isnull()]
-del species['ValidationSummary']
-
-latest = all[all['year'] == '2020']
-latest = latest.merge(species, how='left', on=['scientificName'])
-latest['scientificNameID'] = 'urn:lsid:marinespecies.org:taxname:' + latest['AphiaID']
-
-latest_events = latest[events.columns].drop_duplicates()
-latest_occurrences = latest[occurrences.columns.to_list() + ['scientificNameID']]
-latest_events.to_csv('result_files/dnv-events-2020.csv', index=False)
-latest_occurrences.to_csv('result_files/dnv-occurrences-2020.csv', index=False)
-
-old = pd.read_csv('source_files/old-occurrence.txt', dtype='str', delimiter='\t')
-old = old.merge(species, how='left', on=['scientificName'])
-old[old['AphiaID'].isnull()]['scientificName'].drop_duplicates()
-old['scientificNameID'] = 'urn:lsid:marinespecies.org:taxname:' + old['AphiaID']
-old.to_csv('result_files/dnv-occurrences-updatedwithaphia.txt', index=False, sep='\t')
-
-#events.to_csv('result_files/dnv-events.csv', index=False)
-#occurrences.to_csv('result_files/dnv-occurrences.csv', index=False)
-import pdb; pdb.set_trace()
+if __name__ == '__main__':
+    main()
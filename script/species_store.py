@@ -0,0 +1,112 @@
+from contextlib import closing
+from excel_cache import CACHE_DIR, file_hash
+import os
+import sqlite3
+import pandas as pd
+
+SPECIES_TABLE = 'source_files/species_table.csv'
+SPECIES_STORE = os.path.join(CACHE_DIR, 'species_table.sqlite')
+LSID_PREFIX = 'urn:lsid:marinespecies.org:taxname:'
+NAME_PARTICLES = {'d', 'da', 'de', 'del', 'della', 'der', 'di', 'du', 'la', 'le', 'van', 'von'}
+BATCH_SIZE = 900 # SQLite allows 999 parameters per query in older versions
+STORE_VERSION = '2' # Bump when normalise_name or the layout of the store changes, stores built before are rebuilt
+
+def normalise_name(name): # 'Eunereis elitoralis (Eliason, 1962)' and 'Brachyura juv.' become 'Eunereis elitoralis' and 'Brachyura'
+    tokens = str(name).split()
+    if tokens and tokens[-1] in ('juv', 'juv.'):
+        tokens = tokens[:-1]
+    kept = tokens[:1]
+    for i, token in enumerate(tokens[1:], 1): # Epithets are lower case, authorship starts with a capital, a bracket or a particle such as 'van'
+        following = tokens[i + 1] if i + 1 < len(tokens) else ''
+        if is_subgenus(token) and following[:1].islower(): # 'Abra (Abra) alba' is 'Abra alba', the subgenus does not end the name
+            continue
+        if not token[0].islower() or token.startswith("d'") or (token in NAME_PARTICLES and following[:1].isupper()):
+            break
+        kept.append(token)
+    return ' '.join(kept)
+
+def is_subgenus(token): # '(Abra)', unlike an authorship such as '(Eliason, 1962)' or '(Linnaeus)' it is followed by an epithet
+    return len(token) > 3 and token[0] == '(' and token[-1] == ')' and token[1].isupper() and token[2:-1].isalpha()
+
+def build_store(csv_path=SPECIES_TABLE, store_path=SPECIES_STORE): # Only rebuilt when species_table.csv or STORE_VERSION changes
+    digest = file_hash(csv_path) + '-' + STORE_VERSION
+    if stored_digest(store_path) == digest:
+        return store_path
+    species = pd.read_csv(csv_path, dtype='str')
+    species = species[species['Source'].isnull()].drop(columns=['ValidationSummary'], errors='ignore')
+    species = species.drop_duplicates('scientificName')
+    species.insert(0, 'normalised', species['scientificName'].map(normalise_name))
+    os.makedirs(os.path.dirname(store_path) or '.', exist_ok=True)
+    temporary = store_path + '.' + str(os.getpid()) + '.tmp'
+    with closing(sqlite3.connect(temporary)) as connection:
+        species.to_sql('species', connection, index=False)
+        connection.execute('CREATE INDEX species_name ON species (scientificName)')
+        connection.execute('CREATE INDEX species_normalised ON species (normalised)')
+        connection.execute('CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)')
+        connection.execute("INSERT INTO metadata VALUES ('source_hash', ?)", (digest,))
+        connection.commit()
+    os.replace(temporary, store_path)
+    return store_path
+
+def stored_digest(store_path):
+    if not os.path.exists(store_path):
+        return None
+    with closing(sqlite3.connect(store_path)) as connection:
+        try:
+            return connection.execute("SELECT value FROM metadata WHERE key = 'source_hash'").fetchone()[0]
+        except (sqlite3.Error, TypeError):
+            return None
+
+def lookup_names(names, store_path=SPECIES_STORE): # Returns the species table rows indexed by the requested names, and the names without a match
+    names = pd.unique(pd.Series(list(names), dtype=object).dropna())
+    with closing(sqlite3.connect(store_path)) as connection:
+        exact = query(connection, 'scientificName', names)
+        remaining = [name for name in names if name not in exact.index]
+        normalised = pd.Series([normalise_name(name) for name in remaining], index=remaining, dtype=object)
+        keys = normalised.unique()
+        exact_normalised = query(connection, 'scientificName', keys) # 'Abra juv.' is 'Abra' when the table has it, not a species normalised to 'Abra'
+        fuzzy = unambiguous(query(connection, 'normalised', [key for key in keys if key not in exact_normalised.index], first=False), 'normalised')
+    resolved = pd.concat([exact_normalised, fuzzy])
+    matches = pd.concat([exact, resolved.reindex(normalised.values).set_axis(normalised.index)]).reindex(names)
+    matches = matches.drop(columns=['scientificName', 'normalised'], errors='ignore')
+    unmatched = list(matches.index[matches['AphiaID'].isnull()])
+    return matches, unmatched
+
+def query(connection, column, values, first=True): # Rows for each value of column, indexed by it, only the first one of each value if first
+    values = list(values)
+    batches = [pd.read_sql('SELECT * FROM species WHERE ' + column + ' IN (' + ', '.join('?' * len(batch)) + ') ORDER BY rowid', connection, params=batch)
+               for batch in (values[i:i + BATCH_SIZE] for i in range(0, len(values), BATCH_SIZE))]
+    if not batches:
+        batches = [pd.read_sql('SELECT * FROM species WHERE 0', connection)]
+    rows = pd.concat(batches)
+    if first:
+        rows = rows.drop_duplicates(column)
+    rows.index = rows[column].values
+    return rows
+
+def unambiguous(rows, column): # Values of column shared by rows with different AphiaIDs can not be resolved, they are left unmatched
+    aphia_ids = rows.groupby(column)['AphiaID'].nunique()
+    rows = rows[rows[column].map(aphia_ids).to_numpy() == 1].drop_duplicates(column)
+    rows.index = rows[column].values
+    return rows
+
+def scientific_name_ids(names, store_path=SPECIES_STORE): # Name to WoRMS LSID, for the names that matched
+    matches, unmatched = lookup_names(names, store_path)
+    return (LSID_PREFIX + matches['AphiaID'].dropna()), unmatched
+
+def annotate_occurrence_file(in_path, out_path, store_path=SPECIES_STORE, chunksize=100000, sep='\t'): # Adds the species table columns and scientificNameID chunk by chunk, so memory stays flat however large the file is
+    known = None # Species table rows of every name seen so far, indexed by name
+    unmatched = []
+    with open(out_path, 'w', newline='', encoding='utf-8') as out:
+        for i, chunk in enumerate(pd.read_csv(in_path, dtype='str', delimiter=sep, chunksize=chunksize)):
+            names = pd.Index(chunk['scientificName'].dropna().unique())
+            if known is not None:
+                names = names[~names.isin(known.index)]
+            if known is None or len(names):
+                matches, chunk_unmatched = lookup_names(names, store_path)
+                known = matches if known is None else pd.concat([known, matches])
+                unmatched += chunk_unmatched
+            chunk = chunk.join(known, on='scientificName')
+            chunk['scientificNameID'] = LSID_PREFIX + chunk['AphiaID']
+            chunk.to_csv(out, index=False, sep=sep, header=i == 0)
+    return unmatched
@@ -0,0 +1,56 @@
+from pyproj import Transformer
+import os
+import numpy as np
+import pandas as pd
+
+OTHER_COORDINATES = ['UTM31E', 'UTM31N', 'UTM32E', 'UTM32N', 'UTM34E', 'UTM34N', 'UTM35E', 'UTM35N', 'UTM36E', 'UTM36N', 'ED50E', 'ED50N']
+OVERRIDDEN_NAMES = ['Crustacea juv.', 'Oligochaeta', 'Grania', 'Brachyura juv.', 'Pectinoidea', 'Gammaridea'] # Exercise set_taxonomy_data
+
+def make_biology_report(species=500, stations=60, grabs=5, years=range(2006, 2021, 2), density=0.05, seed=0): # Species x '<year> <station> <grab>' pivot like the MOD Biology_Report
+    rng = np.random.default_rng(seed)
+    names = (OVERRIDDEN_NAMES + ['Genus' + str(i // 4) + ' species' + str(i) for i in range(species)])[:species]
+    families = ['Family' + str(i // 12) if i % 10 else None for i in range(species)]
+    headers = [str(year) + ' ' + station + ' ' + str(grab) for year in years for station in station_codes(stations) for grab in range(1, grabs + 1)]
+    counts = rng.geometric(0.15, size=(species, len(headers))).astype(float)
+    counts[rng.random(counts.shape) >= density] = np.nan
+    counts[rng.random(counts.shape) < density / 10] = 0 # MOD also exports some explicit zeros
+    pivot = pd.DataFrame(counts, columns=headers)
+    pivot.insert(0, 'Family', families)
+    pivot.insert(0, 'Species', names)
+    return pivot
+
+def make_stations_report(stations=60, utm_only=0.3, other_zones=0.3, seed=0): # A utm_only share of stations lack WGS84, an other_zones share of those only has UTM31, UTM32 or ED50
+    rng = np.random.default_rng(seed)
+    longitude = rng.uniform(2, 30, stations)
+    latitude = rng.uniform(56, 72, stations)
+    report = pd.DataFrame({
+        'Installation': ['Installation' + str(i // 6) for i in range(stations)],
+        'Station': station_codes(stations),
+        'Direction': np.where(rng.random(stations) < 0.5, rng.integers(0, 360, stations), np.nan),
+        'Distance': np.where(rng.random(stations) < 0.5, rng.integers(250, 10000, stations), np.nan),
+        'Depth': rng.integers(60, 400, stations),
+    })
+    report['UTM33E'], report['UTM33N'] = project('EPSG:32633', longitude, latitude)
+    for column in OTHER_COORDINATES:
+        report[column] = ''
+    report['WGS84E'], report['WGS84N'] = longitude, latitude
+
+    without_wgs84 = rng.random(stations) < utm_only
+    report.loc[without_wgs84, ['WGS84E', 'WGS84N']] = np.nan
+    in_other_zones = np.flatnonzero(without_wgs84 & (rng.random(stations) < other_zones))
+    for (easting, northing, crs), rows in zip([('UTM31E', 'UTM31N', 'EPSG:32631'), ('UTM32E', 'UTM32N', 'EPSG:32632'), ('ED50E', 'ED50N', 'EPSG:23031')], np.array_split(in_other_zones, 3)):
+        report.loc[rows, ['UTM33E', 'UTM33N']] = np.nan
+        report.loc[rows, easting], report.loc[rows, northing] = project(crs, longitude[rows], latitude[rows])
+    return report
+
+def station_codes(stations):
+    return ['ST' + str(i) + '-' + str(i % 7) for i in range(stations)]
+
+def project(crs, longitude, latitude):
+    return Transformer.from_crs('EPSG:4326', crs, always_xy=True).transform(longitude, latitude)
+
+def write_xlsx(biology_report, stations_report, current_sea, directory='source_files'): # Same file and sheet names as the MOD exports script.py reads, needs openpyxl
+    file_sea_name = current_sea.lower().replace(' ', '_')
+    os.makedirs(directory, exist_ok=True)
+    biology_report.to_excel(os.path.join(directory, file_sea_name + '.xlsx'), sheet_name='Biology_Report.xlsx', index=False)
+    stations_report.to_excel(os.path.join(directory, file_sea_name + '_stations.xlsx'), sheet_name='Stations_Report.xlsx', index=False)
@@ -1,8 +1,22 @@
 import unittest
-from dnvmodtodwc import reverse_occurrence_pivot, add_uuids, create_event_sheet, set_taxonomy_data, set_location_data, get_event_and_occurrence
+from dnvmodtodwc import reverse_occurrence_pivot, build_station_index, add_uuids, random_ids, create_event_sheet, set_taxonomy_data, set_location_data, get_event_and_occurrence
+from script import main, process_seas, parse_years
 import pandas as pd
 import numpy as np
 import uuid
+import io
+import json
+import os
+import tempfile
+import excel_cache
+import species_store
+import synthetic
+import delta
+import dwca
+import zipfile
+from xml.etree import ElementTree
+from instrumentation import Recorder, NULL_RECORDER
+from benchmark import compare
 
 
 class TestGetEventAndOccurrence(unittest.TestCase):
@@ -29,17 +43,19 @@ class TestGetEventAndOccurrence(unittest.TestCase):
         np.testing.assert_array_equal(event.columns, expected_event_cols)
         expected_occurrence_cols = ['scientificName', 'family', 'Station', 'individualCount', 'occurrenceID', 'eventID', 'basisOfRecord', 'phylum', 'class', 'order']
         np.testing.assert_array_equal(occurrence.columns, expected_occurrence_cols)
+        event, occurrence = get_event_and_occurrence(pivot_data, stations_report, 'UK Shelf', years=2010)
+        np.testing.assert_array_equal(event['year'].values, ['2010'])
+        np.testing.assert_array_equal(occurrence['individualCount'].values, [3])
 
 
 class TestCreateEventSheet(unittest.TestCase):
     def setUp(self):
-        occurrence = pd.DataFrame({'Station': ['2008 R10-1 1', '2008 R10-1 1', '2008 R10-1 2', '2010 NV9 5'],
-                                   'eventID': [10, 10, 11, 12],
-                                   'Species': ['A', 'B', 'A', 'A']})
+        station_index = build_station_index(['2008 R10-1 1', '2008 R10-1 2', '2010 NV9 5'])
+        station_index['eventID'] = [10, 11, 12]
         stations_report = pd.DataFrame({'Station': ['R10-1', 'NV9'], 'WGS84E': [2, 3], 'WGS84N': [60, 61]})
-        self.event = create_event_sheet(occurrence, stations_report)
+        self.event = create_event_sheet(station_index, stations_report)
 
-    def test_it_creates_one_event_per_event_id(self):
+    def test_it_creates_one_event_per_station_header(self):
         np.testing.assert_array_equal(self.event['eventID'].values, [10, 11, 12])
 
     def test_it_separates_station_correctly(self):
@@ -59,6 +75,21 @@ class TestCreateEventSheet(unittest.TestCase):
         np.testing.assert_array_equal(self.event['WGS84N'].values, [60, 60, 61])
 
 
+class TestBuildStationIndex(unittest.TestCase):
+    def test_it_splits_headers_into_year_station_and_grab(self):
+        station_index = build_station_index(['2008 R10-1 1', '2010 NV9 5', '2011 Station 12 2'])
+        np.testing.assert_array_equal(station_index['header'].values, ['2008 R10-1 1', '2010 NV9 5', '2011 Station 12 2'])
+        np.testing.assert_array_equal(station_index['year'].values, ['2008', '2010', '2011'])
+        np.testing.assert_array_equal(station_index['Station'].values, ['R10-1', 'NV9', 'Station 12'])
+        np.testing.assert_array_equal(station_index['grab'].values, ['1', '5', '2'])
+
+    def test_add_uuids_broadcasts_event_ids_from_the_index(self):
+        occurrence = reverse_occurrence_pivot(pd.DataFrame({'Species': ['A', 'B'], 'Family': ['D', 'E'], '2008 R10-1 1': [1, 2], '2010 NV9 5': [None, 3]}))
+        station_index = build_station_index(occurrence['Station'].cat.categories)
+        add_uuids(occurrence, station_index)
+        np.testing.assert_array_equal(occurrence['eventID'].values, station_index['eventID'].values[[0, 0, 1]])
+
+
 class TestSetLocationData(unittest.TestCase):
     def setUp(self):
         self.event = pd.DataFrame({'Station': ['J1', 'J2', 'J3'],
@@ -79,7 +110,7 @@ class TestSetLocationData(unittest.TestCase):
         np.testing.assert_array_equal(self.event['waterBody'].values, ['UK Shelf', 'UK Shelf', 'UK Shelf'])
 
     def test_it_assigns_correct_geodetic_datums(self):
-        np.testing.assert_array_equal(self.event['geodeticDatum'].values, ['WGS84', 'EPSG:32633', 'EPSG:32633'])
+        np.testing.assert_array_equal(self.event['geodeticDatum'].values, ['WGS84', 'WGS84', 'WGS84'])
 
     def test_it_creates_sensible_location_remarks(self):
         expected = ['station J1, direction from station: 30, distance from station: 1', 'station J2',
@@ -100,10 +131,43 @@ class TestSetLocationData(unittest.TestCase):
         np.testing.assert_array_equal(self.event['verbatimCoordinateSystem'].values, ['UTM', 'UTM', 'UTM'])
 
     def test_conversion_from_utm(self):
-        # These tests fail
-        #np.testing.assert_array_equal(self.event['decimalLatitude'].values, [70, 72.62495717, 73.86281664])
-        #np.testing.assert_array_equal(self.event['decimalLongitude'].values, [20, 24.9108405, 24.54679897])
-        pass
+        np.testing.assert_array_almost_equal(self.event['decimalLatitude'].values.astype(float), [70, 72.62495717, 73.86281664], decimal=2)
+        np.testing.assert_array_almost_equal(self.event['decimalLongitude'].values.astype(float), [20, 24.9108405, 24.54679897], decimal=2)
+
+    def test_it_converts_every_utm_zone_and_ed50(self):
+        event = pd.DataFrame({'Station': ['A', 'B', 'C', 'D'],
+                              'Depth': [100, 101, 102, 103],
+                              'Direction': [None, None, None, None],
+                              'Distance': [None, None, None, None],
+                              'Installation': ['Jeba'] * 4,
+                              'WGS84N': [None, None, None, None],
+                              'WGS84E': [None, None, None, None],
+                              'UTM33N': ['', '', '', ''], 'UTM33E': ['', '', '', ''],
+                              'UTM31E': [500000, '', '', ''], 'UTM31N': [6260000, '', '', ''],
+                              'UTM32E': ['', 500000, '', ''], 'UTM32N': ['', 6500000, '', ''],
+                              'UTM34E': '', 'UTM34N': '', 'UTM35E': '', 'UTM35N': '', 'UTM36E': '', 'UTM36N': '',
+                              'ED50E': ['', '', 500000, ''], 'ED50N': ['', '', 6260000, '']})
+        set_location_data(event, 'Ekofisk')
+        np.testing.assert_array_equal(event['verbatimSrS'].values[:3], ['EPSG:32631', 'EPSG:32632', 'EPSG:23031'])
+        np.testing.assert_array_equal(event['geodeticDatum'].values[:3], ['WGS84', 'WGS84', 'WGS84']) # The converted coordinates, the source CRS stays in verbatimSrS
+        self.assertTrue(event[['verbatimSrS', 'geodeticDatum', 'verbatimCoordinateSystem']].iloc[3].isnull().all())
+        np.testing.assert_array_equal(event['verbatimLongitude'].values[:3], [500000, 500000, 500000])
+        np.testing.assert_array_almost_equal(event['decimalLongitude'].values[:3].astype(float), [3, 9, 3], decimal=2)
+        np.testing.assert_array_almost_equal(event['decimalLatitude'].values[:3].astype(float), [56.48, 58.64, 56.48], decimal=2)
+        self.assertTrue(pd.isnull(event['decimalLatitude'].values[3]))
+        self.assertNotIn('UTM31E', event.columns)
+
+    def test_it_leaves_ed50_unconverted_outside_the_north_sea(self):
+        event = pd.DataFrame({'Station': ['A', 'B'], 'Depth': [100, 101], 'Direction': [None, None], 'Distance': [None, None], 'Installation': ['Jeba'] * 2,
+                              'WGS84N': [None, None], 'WGS84E': [None, None], 'UTM33N': ['', 7800000], 'UTM33E': ['', 500000],
+                              'UTM31E': '', 'UTM31N': '', 'UTM32E': '', 'UTM32N': '', 'UTM34E': '', 'UTM34N': '', 'UTM35E': '', 'UTM35N': '', 'UTM36E': '', 'UTM36N': '',
+                              'ED50E': [500000, ''], 'ED50N': [7800000, '']})
+        set_location_data(event, 'Finnmark')
+        np.testing.assert_array_equal(event['verbatimSrS'].values, ['ED50', 'EPSG:32633'])
+        np.testing.assert_array_equal(event['verbatimLongitude'].values, [500000, 500000])
+        self.assertTrue(pd.isnull(event['decimalLatitude'].values[0]))
+        self.assertTrue(pd.isnull(event['geodeticDatum'].values[0]))
+        np.testing.assert_array_almost_equal(float(event['decimalLongitude'].values[1]), 15, decimal=2)
 
     def test_does_not_break_if_no_conversion_needed(self):
         event = pd.DataFrame({'Station': ['J1', 'J2'],
@@ -146,11 +210,39 @@ class TestReverseOccurrencePivot(unittest.TestCase):
                                 '2011 EI12 1': [4, 5, 6]})
         result = reverse_occurrence_pivot(test_df)
         df_cols = {'Species': ['A', 'C', 'B', 'A', 'B', 'C'],
-                   'Family': [None, 'F', None, None, None, 'F'],
+                   'Family': [np.nan, 'F', np.nan, np.nan, np.nan, 'F'], # Missing families are NaN in the categorical
                    'Station': ['2008 R10-1 1', '2008 R10-1 1', '2010 NV9 5', '2011 EI12 1', '2011 EI12 1', '2011 EI12 1'],
                    'individualCount': [1, 2, 3, 4, 5, 6]}
         expected_result = pd.DataFrame(df_cols)
-        np.testing.assert_array_equal(result.values, expected_result.values)
+        pd.testing.assert_frame_equal(result.astype(object), expected_result.astype(object))
+
+    def test_it_uses_compact_dtypes(self):
+        test_df = pd.DataFrame({'Species': ['A', 'B'],
+                                'Family': ['D', 'E'],
+                                '2008 R10-1 1': [1, 0.5],
+                                '2010 NV9 5': [None, None],
+                                '2011 EI12 1': [4.7, -2]})
+        result = reverse_occurrence_pivot(test_df)
+        for column in ['Species', 'Family', 'Station']:
+            self.assertIsInstance(result[column].dtype, pd.CategoricalDtype)
+        self.assertEqual(result['individualCount'].dtype, np.int32)
+        np.testing.assert_array_equal(result['individualCount'].values, [1, 4])
+        np.testing.assert_array_equal(result['Station'].cat.categories, ['2008 R10-1 1', '2011 EI12 1'])
+
+    def test_it_only_melts_the_selected_years(self):
+        test_df = pd.DataFrame({'Species': ['A', 'B'],
+                                'Family': ['D', 'E'],
+                                '2008 R10-1 1': [1, 2],
+                                '2010 NV9 5': [3, None],
+                                '2011 EI12 1': [4, 5]})
+        np.testing.assert_array_equal(reverse_occurrence_pivot(test_df, 2010)['Station'].values, ['2010 NV9 5'])
+        np.testing.assert_array_equal(reverse_occurrence_pivot(test_df, '2011')['individualCount'].values, [4, 5])
+        np.testing.assert_array_equal(reverse_occurrence_pivot(test_df, range(2009, 2012))['Station'].values, ['2010 NV9 5', '2011 EI12 1', '2011 EI12 1'])
+        self.assertEqual(len(reverse_occurrence_pivot(test_df, 2020)), 0)
+
+    def test_parse_years(self):
+        self.assertEqual(list(parse_years('2020')), [2020])
+        self.assertEqual(list(parse_years('2018-2020')), [2018, 2019, 2020])
 
 
 class TestAddUUIDs(unittest.TestCase):
@@ -185,6 +277,35 @@ class TestAddUUIDs(unittest.TestCase):
         self.assertEqual(len(self.result['eventID'].values) - 1, len(set(self.result['eventID'].values)))
 
 
+class TestNameBasedUUIDs(unittest.TestCase):
+    def add_uuids(self, current_sea='UK Shelf'):
+        result = pd.DataFrame({'Station': ['2008 R10-1 1', '2008 R10-1 1', '2010 NV9 5', '2010 NV9 5'],
+                               'Species': ['A', 'B', 'A', 'A']})
+        add_uuids(result, id_strategy='uuid5', current_sea=current_sea)
+        return result
+
+    def test_it_creates_the_same_ids_every_run(self):
+        first, second = self.add_uuids(), self.add_uuids()
+        np.testing.assert_array_equal(first['occurrenceID'].values, second['occurrenceID'].values)
+        np.testing.assert_array_equal(first['eventID'].values, second['eventID'].values)
+        self.assertEqual(first['occurrenceID'][0].version, 5)
+
+    def test_it_creates_unique_ids_for_repeated_species(self):
+        self.assertEqual(len(set(self.add_uuids()['occurrenceID'].values)), 4)
+
+    def test_it_uses_the_sea_in_the_ids(self):
+        self.assertNotEqual(self.add_uuids('UK Shelf')['eventID'][0], self.add_uuids('Ekofisk')['eventID'][0])
+
+    def test_it_accepts_an_id_function(self):
+        result = pd.DataFrame({'Station': ['2008 R10-1 1', '2010 NV9 5'], 'Species': ['A', 'B']})
+        add_uuids(result, id_strategy=lambda names: list(names), current_sea='More')
+        np.testing.assert_array_equal(result['occurrenceID'].values, ['More|2008 R10-1 1|A', 'More|2010 NV9 5|B'])
+        np.testing.assert_array_equal(result['eventID'].values, ['More|2008 R10-1 1', 'More|2010 NV9 5'])
+
+    def test_random_ids_are_version_4(self):
+        self.assertTrue(all(id.version == 4 for id in random_ids(['a'] * 10)))
+
+
 class TestSetTaxonomyData(unittest.TestCase):
     def test_it_sets_basis_of_record(self):
         occurrences = pd.DataFrame({'Species': ['A', 'Grania', 'Grania', 'Oligochaeta', 'Oligochaeta juv.', 'Z'], 'Family': ['F', 'G', 'H', 'H', 'H', 'I']})
@@ -219,5 +340,399 @@ class TestSetTaxonomyData(unittest.TestCase):
         set_taxonomy_data(occurrences)
         np.testing.assert_array_equal(occurrences['scientificName'], ['A', 'B', 'Amphitrite Müller, 1771', 'C', 'Veneroidea Rafinesque, 1815', 'Z', 'Amphipoda'])
 
+    def test_it_keeps_names_categorical(self):
+        occurrences = reverse_occurrence_pivot(pd.DataFrame({'Species': ['Crustacea', 'Crustacea juv.', 'Grania'], 'Family': ['F', 'G', None], '2008 R10-1 1': [1, 2, 3]}))
+        set_taxonomy_data(occurrences)
+        self.assertIsInstance(occurrences['scientificName'].dtype, pd.CategoricalDtype)
+        self.assertEqual(len(occurrences['scientificName'].cat.categories), 2)
+        np.testing.assert_array_equal(occurrences['family'], ['F', 'G', 'Enchytraeidae'])
+
+    def test_it_reads_overrides_from_a_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'overrides.json')
+            with open(path, 'w') as f:
+                json.dump({'version': 2, 'phylum': {'A': 'P'}, 'class': {}, 'order': {'B': 'O'}, 'scientificName': {'A': 'A2'}, 'family': {'A2': 'F2'}}, f)
+            occurrences = pd.DataFrame({'Species': ['A', 'B', 'C', 'A'], 'Family': ['F', 'G', 'H', None]})
+            set_taxonomy_data(occurrences, path)
+        np.testing.assert_array_equal(occurrences['scientificName'], ['A2', 'B', 'C', 'A2'])
+        np.testing.assert_array_equal(occurrences['phylum'], ['P', '', '', 'P'])
+        np.testing.assert_array_equal(occurrences['order'], ['', 'O', '', ''])
+        np.testing.assert_array_equal(occurrences['family'], ['F2', 'G', 'H', 'F2'])
+
+
+def fake_process_sea(current_sea):
+    if current_sea == 'Broken':
+        raise ValueError('Unreadable workbook')
+    return pd.DataFrame({'waterBody': [current_sea]}), pd.DataFrame({'sea': [current_sea]}), [{'stage': 'fake', 'sea': current_sea}]
+
+
+class TestProcessSeas(unittest.TestCase):
+    def test_it_returns_results_in_sea_order(self):
+        seas = ['UK Shelf', 'Ekofisk', 'More', 'Finnmark']
+        events, occurrences, failures = process_seas(seas, workers=2, process=fake_process_sea)
+        self.assertEqual([event['waterBody'][0] for event in events], seas)
+        self.assertEqual([occurrence['sea'][0] for occurrence in occurrences], seas)
+        self.assertEqual(failures, {})
+
+    def test_it_keeps_other_seas_when_one_fails(self):
+        events, occurrences, failures = process_seas(['UK Shelf', 'Broken', 'More'], workers=2, process=fake_process_sea)
+        self.assertEqual([event['waterBody'][0] for event in events], ['UK Shelf', 'More'])
+        self.assertEqual(list(failures.keys()), ['Broken'])
+        self.assertIn('Unreadable workbook', failures['Broken'])
+
+    def test_it_can_run_without_a_pool(self):
+        events, occurrences, failures = process_seas(['UK Shelf', 'Broken'], workers=1, process=fake_process_sea)
+        self.assertEqual(len(events), 1)
+        self.assertIn('Unreadable workbook', failures['Broken'])
+
+class TestExcelCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.directory.name, 'cache')
+        self.path = os.path.join(self.directory.name, 'ekofisk.xlsx')
+        pd.DataFrame({'Species': ['A', 'B'], '2008 R10-1 1': [1, None]}).to_excel(self.path, sheet_name='Biology_Report.xlsx', index=False)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_it_returns_the_same_data_as_parsing_the_workbook(self):
+        first = excel_cache.read_sheet(self.path, 'Biology_Report.xlsx', self.cache_dir)
+        second = excel_cache.read_sheet(self.path, 'Biology_Report.xlsx', self.cache_dir)
+        pd.testing.assert_frame_equal(first, pd.ExcelFile(self.path).parse('Biology_Report.xlsx'))
+        pd.testing.assert_frame_equal(second, first)
+        self.assertEqual(len(excel_cache.list_entries(self.cache_dir)), 1)
+
+    def test_missing_text_is_nan_like_in_the_workbook(self):
+        stations_path = os.path.join(self.directory.name, 'ekofisk_stations.xlsx')
+        pd.DataFrame({'Station': ['A', 'B'], 'Direction': ['NE', None], 'Distance': [250, None]}).to_excel(stations_path, sheet_name='Stations_Report.xlsx', index=False)
+        parsed = pd.ExcelFile(stations_path).parse('Stations_Report.xlsx')
+        excel_cache.read_sheet(stations_path, 'Stations_Report.xlsx', self.cache_dir)
+        cached = excel_cache.read_sheet(stations_path, 'Stations_Report.xlsx', self.cache_dir)
+        self.assertEqual([type(value) for value in cached['Direction']], [type(value) for value in parsed['Direction']])
+        self.assertIsNot(cached['Direction'][1], None)
+        self.assertEqual(str(cached['Direction'][1]), str(parsed['Direction'][1]))
+
+    def test_it_loads_from_the_cache_when_the_workbook_is_unchanged(self):
+        excel_cache.read_sheet(self.path, 'Biology_Report.xlsx', self.cache_dir)
+        [(workbook, digest, cached)] = excel_cache.list_entries(self.cache_dir)
+        excel_cache.write_entry(pd.DataFrame({'Species': ['cached']}), os.path.splitext(cached)[0])
+        self.assertEqual(excel_cache.read_sheet(self.path, 'Biology_Report.xlsx', self.cache_dir)['Species'][0], 'cached')
+
+    def test_it_keys_entries_on_content(self):
+        excel_cache.read_sheet(self.path, 'Biology_Report.xlsx', self.cache_dir)
+        pd.DataFrame({'Species': ['C'], '2008 R10-1 1': [3]}).to_excel(self.path, sheet_name='Biology_Report.xlsx', index=False)
+        self.assertEqual(excel_cache.read_sheet(self.path, 'Biology_Report.xlsx', self.cache_dir)['Species'][0], 'C')
+        self.assertEqual(len(excel_cache.list_entries(self.cache_dir)), 2)
+
+    def test_prune_removes_stale_entries(self):
+        excel_cache.read_sheet(self.path, 'Biology_Report.xlsx', self.cache_dir)
+        pd.DataFrame({'Species': ['C'], '2008 R10-1 1': [3]}).to_excel(self.path, sheet_name='Biology_Report.xlsx', index=False)
+        excel_cache.read_sheet(self.path, 'Biology_Report.xlsx', self.cache_dir)
+        self.assertEqual(len(excel_cache.prune([self.path], self.cache_dir)), 1)
+        self.assertEqual([digest for workbook, digest, cached in excel_cache.list_entries(self.cache_dir)], [excel_cache.file_hash(self.path)])
+        excel_cache.prune([], self.cache_dir)
+        self.assertEqual(excel_cache.list_entries(self.cache_dir), [])
+
+    def test_invalidate_removes_all_entries_for_a_workbook(self):
+        excel_cache.read_sheet(self.path, 'Biology_Report.xlsx', self.cache_dir)
+        self.assertEqual(len(excel_cache.invalidate(self.path, self.cache_dir)), 1)
+        self.assertEqual(excel_cache.list_entries(self.cache_dir), [])
+
+    def test_it_handles_columns_with_mixed_types(self):
+        mixed = pd.DataFrame({'Direction': pd.Series([30, 'N', None], dtype=object)})
+        excel_cache.write_entry(mixed, os.path.join(self.cache_dir, 'mixed'))
+        [cached] = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)]
+        pd.testing.assert_frame_equal(excel_cache.read_entry(cached), mixed)
+
+class TestSpeciesStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.csv_path = os.path.join(self.directory.name, 'species_table.csv')
+        self.store_path = os.path.join(self.directory.name, 'species_table.sqlite')
+        pd.DataFrame({'scientificName': ['Abra alba', 'Eunereis elitoralis', 'Brachyura', 'Manual', 'Abra alba'],
+                      'AphiaID': ['141433', '130366', '106673', '1', '2'],
+                      'Source': [None, None, None, 'manual', None],
+                      'ValidationSummary': ['', '', '', '', '']}).to_csv(self.csv_path, index=False)
+        species_store.build_store(self.csv_path, self.store_path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_it_normalises_names(self):
+        self.assertEqual(species_store.normalise_name('Eunereis elitoralis (Eliason, 1962)'), 'Eunereis elitoralis')
+        self.assertEqual(species_store.normalise_name('Hyperiidea H. Milne Edwards, 1830'), 'Hyperiidea')
+        self.assertEqual(species_store.normalise_name('Caecum glabrum de Folin, 1870'), 'Caecum glabrum')
+        self.assertEqual(species_store.normalise_name('Brachyura juv.'), 'Brachyura')
+        self.assertEqual(species_store.normalise_name('Nephtys  sp.'), 'Nephtys sp.')
+
+    def test_it_looks_up_exact_and_normalised_names(self):
+        matches, unmatched = species_store.lookup_names(['Abra alba', 'Eunereis elitoralis (Eliason, 1962)', 'Brachyura juv.', 'Abra alba'], self.store_path)
+        np.testing.assert_array_equal(matches.index, ['Abra alba', 'Eunereis elitoralis (Eliason, 1962)', 'Brachyura juv.'])
+        np.testing.assert_array_equal(matches['AphiaID'].values, ['141433', '130366', '106673'])
+        self.assertEqual(unmatched, [])
+
+    def test_subgenus_does_not_end_the_name(self):
+        self.assertEqual(species_store.normalise_name('Abra (Abra) alba (W. Wood, 1802)'), 'Abra alba')
+        self.assertEqual(species_store.normalise_name('Abra alba (Linnaeus)'), 'Abra alba')
+        pd.DataFrame({'scientificName': ['Abra (Abra) alba', 'Abra', 'Abra (Abra) nitida', 'Nucula (Nucula) nitidosa', 'Nucula (Lamellinucula) nitidosa'],
+                      'AphiaID': ['1', '2', '3', '4', '5'], 'Source': [None] * 5, 'ValidationSummary': [''] * 5}).to_csv(self.csv_path, index=False)
+        species_store.build_store(self.csv_path, self.store_path)
+        matches, unmatched = species_store.lookup_names(['Abra juv.', 'Abra alba', 'Abra nitida (O.F. Müller, 1776)', 'Nucula nitidosa'], self.store_path)
+        self.assertEqual(matches['AphiaID'].fillna('').to_dict(), {'Abra juv.': '2', 'Abra alba': '1', 'Abra nitida (O.F. Müller, 1776)': '3', 'Nucula nitidosa': ''})
+        self.assertEqual(unmatched, ['Nucula nitidosa']) # Two subgenera normalise to the same name
+
+    def test_it_reports_unmatched_names(self):
+        matches, unmatched = species_store.lookup_names(['Abra alba', 'Manual', 'Nothing'], self.store_path)
+        self.assertEqual(unmatched, ['Manual', 'Nothing'])
+
+    def test_it_looks_up_more_names_than_fit_in_one_query(self):
+        names = ['Abra alba'] + ['Name ' + str(i) for i in range(2000)]
+        matches, unmatched = species_store.lookup_names(names, self.store_path)
+        self.assertEqual(len(matches), 2001)
+        self.assertEqual(len(unmatched), 2000)
+
+    def test_it_creates_scientific_name_ids(self):
+        ids, unmatched = species_store.scientific_name_ids(['Abra alba', 'Nothing'], self.store_path)
+        self.assertEqual(ids.to_dict(), {'Abra alba': 'urn:lsid:marinespecies.org:taxname:141433'})
+
+    def test_it_rebuilds_when_the_species_table_changes(self):
+        pd.DataFrame({'scientificName': ['Abra alba'], 'AphiaID': ['9'], 'Source': [None], 'ValidationSummary': ['']}).to_csv(self.csv_path, index=False)
+        species_store.build_store(self.csv_path, self.store_path)
+        matches, unmatched = species_store.lookup_names(['Abra alba', 'Brachyura'], self.store_path)
+        self.assertEqual(matches['AphiaID']['Abra alba'], '9')
+        self.assertEqual(unmatched, ['Brachyura'])
+
+    def test_it_annotates_an_occurrence_file_in_chunks(self):
+        in_path = os.path.join(self.directory.name, 'old-occurrence.txt')
+        out_path = os.path.join(self.directory.name, 'updated.txt')
+        old = pd.DataFrame({'occurrenceID': ['1', '2', '3', '4', '5'], 'scientificName': ['Abra alba', 'Nothing', 'Brachyura juv.', 'Abra alba', None]})
+        old.to_csv(in_path, index=False, sep='\t')
+        unmatched = species_store.annotate_occurrence_file(in_path, out_path, self.store_path, chunksize=2)
+        expected = old.merge(pd.DataFrame({'scientificName': ['Abra alba', 'Brachyura juv.'], 'AphiaID': ['141433', '106673'], 'Source': [None, None]}), how='left', on='scientificName')
+        expected['scientificNameID'] = 'urn:lsid:marinespecies.org:taxname:' + expected['AphiaID']
+        pd.testing.assert_frame_equal(pd.read_csv(out_path, dtype='str', delimiter='\t'), pd.read_csv(io.StringIO(expected.to_csv(index=False, sep='\t')), dtype='str', delimiter='\t'))
+        self.assertEqual(unmatched, ['Nothing'])
+
+
+class TestSynthetic(unittest.TestCase):
+    def test_it_makes_a_sparse_biology_report(self):
+        pivot_data = synthetic.make_biology_report(species=40, stations=5, grabs=2, years=[2019, 2020], density=0.1)
+        self.assertEqual(pivot_data.shape, (40, 2 + 5 * 2 * 2))
+        np.testing.assert_array_equal(pivot_data.columns[:3], ['Species', 'Family', '2019 ST0-0 1'])
+        self.assertLess(pivot_data.iloc[:, 2:].notna().to_numpy().mean(), 0.2)
+
+    def test_it_makes_stations_with_and_without_wgs84(self):
+        stations_report = synthetic.make_stations_report(stations=100, utm_only=0.5, other_zones=0.5)
+        without_wgs84 = stations_report['WGS84N'].isnull()
+        self.assertTrue(0 < without_wgs84.sum() < 100)
+        self.assertTrue((stations_report['UTM31E'] != '').any())
+        self.assertTrue(stations_report.loc[~without_wgs84, 'UTM33E'].notna().all())
+
+    def test_the_pipeline_runs_on_synthetic_data(self):
+        pivot_data = synthetic.make_biology_report(species=30, stations=8, grabs=2, years=[2020])
+        event, occurrence = get_event_and_occurrence(pivot_data, synthetic.make_stations_report(stations=8, utm_only=0.5), 'UK Shelf')
+        self.assertEqual(len(occurrence), (pivot_data.iloc[:, 2:] >= 1).to_numpy().sum())
+        self.assertFalse(event['decimalLatitude'].isnull().any())
+
+    def test_benchmark_compare_finds_regressions(self):
+        baseline = {'add_uuids': {'seconds': 1.0, 'peak_bytes': 100}, 'create_event_sheet': {'seconds': 1.0, 'peak_bytes': 100}}
+        results = {'add_uuids': {'seconds': 1.2, 'peak_bytes': 100}, 'create_event_sheet': {'seconds': 2.0, 'peak_bytes': 100}, 'new_stage': {'seconds': 9, 'peak_bytes': 9}}
+        self.assertEqual(compare(results, baseline, 0.25), [('create_event_sheet', 'seconds', 1.0, 2.0)])
+
+class TestMain(unittest.TestCase):
+    def test_it_writes_the_report_when_every_sea_fails(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, 'result_files'))
+            os.chdir(directory)
+            try:
+                with self.assertRaises(SystemExit):
+                    main(['--workers', '1', '--report', 'time', '--no-cache'])
+            finally:
+                os.chdir(cwd)
+            with open(os.path.join(directory, 'result_files', 'run-report.json')) as f:
+                report = json.load(f)
+        self.assertEqual(len(report['failures']), 11)
+        self.assertEqual(report['stages'][-1]['stage'], 'process_seas')
+
+
+class TestInstrumentation(unittest.TestCase):
+    def test_it_records_every_stage_per_sea(self):
+        recorder = Recorder()
+        pivot_data = synthetic.make_biology_report(species=20, stations=4, grabs=2, years=[2020])
+        event, occurrence = get_event_and_occurrence(pivot_data, synthetic.make_stations_report(stations=4), 'More', recorder=recorder)
+        self.assertEqual([record['stage'] for record in recorder.records], ['reverse_occurrence_pivot', 'build_station_index', 'add_uuids', 'set_taxonomy_data', 'create_event_sheet', 'set_location_data'])
+        self.assertEqual({record['sea'] for record in recorder.records}, {'More'})
+        self.assertEqual(recorder.records[0]['rows_in'], 20)
+        self.assertEqual(recorder.records[0]['rows_out'], len(occurrence))
+        self.assertEqual(recorder.records[-1]['rows_out'], len(event))
+        self.assertTrue(all(record['seconds'] >= 0 and record['max_rss_bytes'] > 0 for record in recorder.records))
+
+    def test_it_traces_peak_memory_of_nested_stages(self):
+        recorder = Recorder(trace_memory=True)
+        with recorder.stage('outer'):
+            with recorder.stage('inner'):
+                data = np.ones(1000000)
+            del data
+        inner, outer = recorder.records
+        self.assertGreater(inner['peak_traced_bytes'], 8000000)
+        self.assertGreaterEqual(outer['peak_traced_bytes'], inner['peak_traced_bytes'])
+
+    def test_it_writes_a_json_report(self):
+        recorder = Recorder()
+        with recorder.stage('merge', rows_in=3) as record:
+            record['rows_out'] = 2
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'run-report.json')
+            recorder.write(path, arguments={'years': '2020'})
+            with open(path) as f:
+                report = json.load(f)
+        self.assertEqual(report['arguments'], {'years': '2020'})
+        self.assertEqual(report['stages'][0]['rows_out'], 2)
+
+    def test_the_null_recorder_records_nothing(self):
+        with NULL_RECORDER.stage('merge') as record:
+            record['rows_out'] = 2
+        self.assertEqual(NULL_RECORDER.records, [])
+
+    def test_process_seas_collects_worker_records(self):
+        recorder = Recorder()
+        process_seas(['UK Shelf', 'More'], workers=2, process=fake_process_sea, recorder=recorder)
+        self.assertEqual([record['sea'] for record in recorder.records], ['UK Shelf', 'More'])
+
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        self.previous_events = pd.DataFrame({'eventID': ['e1', 'e2', 'e3'], 'year': ['2019'] * 3, 'Station': ['A', 'B', 'C'], 'eventRemarks': ['grab 1'] * 3, 'waterBody': ['More'] * 3})
+        self.current_events = pd.DataFrame({'eventID': ['e1', 'e2', 'e4'], 'year': ['2019'] * 3, 'Station': ['A', 'B', 'D'], 'eventRemarks': ['grab 1'] * 3, 'waterBody': ['More', 'Ekofisk', 'More']})
+        self.previous_occurrences = pd.DataFrame({'scientificName': ['a', 'b', 'a'], 'occurrenceID': ['o1', 'o2', 'o3'], 'eventID': ['e1', 'e1', 'e3'], 'individualCount': ['1', '2', '3']})
+        self.current_occurrences = pd.DataFrame({'scientificName': ['a', 'b', 'c'], 'occurrenceID': ['o1', 'o2', 'o4'], 'eventID': ['e1', 'e1', 'e4'], 'individualCount': ['1', '5', '3']})
+
+    def test_compare_finds_added_changed_and_removed_rows(self):
+        added, changed, removed = delta.compare(self.previous_events, self.current_events, ['eventID'])
+        np.testing.assert_array_equal(added['eventID'].values, ['e4'])
+        np.testing.assert_array_equal(changed['eventID'].values, ['e2'])
+        np.testing.assert_array_equal(removed['eventID'].values, ['e3'])
+
+    def test_natural_keys_ignore_random_ids(self):
+        current_events = self.previous_events.assign(eventID=['x1', 'x2', 'x3'])
+        current_occurrences = self.previous_occurrences.assign(occurrenceID=['y1', 'y2', 'y3'], eventID=['x1', 'x1', 'x3'])
+        with tempfile.TemporaryDirectory() as directory:
+            manifest = delta.publish_delta(self.previous_events, self.previous_occurrences, current_events, current_occurrences, 'natural', directory)
+        for name in ('events', 'occurrences'):
+            self.assertEqual([manifest[name][change] for change in ('added', 'changed', 'removed')], [0, 0, 0])
+
+    def test_natural_keys_tell_seas_with_the_same_station_apart(self):
+        previous_events = self.previous_events.iloc[:1]
+        current_events = pd.concat([previous_events.assign(eventID='x0', waterBody='Ekofisk'), previous_events.assign(eventID='x1')], ignore_index=True)
+        added, changed, removed = delta.compare(previous_events, current_events, delta.EVENT_KEYS['natural'], delta.ID_COLUMNS)
+        np.testing.assert_array_equal(added['waterBody'].values, ['Ekofisk'])
+        self.assertEqual((len(changed), len(removed)), (0, 0))
+
+    def test_it_writes_the_delta_files_and_a_manifest(self):
+        with tempfile.TemporaryDirectory() as directory:
+            manifest = delta.publish_delta(self.previous_events, self.previous_occurrences, self.current_events, self.current_occurrences, 'natural', directory, years='2019')
+            with open(os.path.join(directory, 'manifest.json')) as f:
+                self.assertEqual(json.load(f)['years'], '2019')
+            changed = pd.read_csv(manifest['occurrences']['changed_file'], dtype='str')
+            removed = pd.read_csv(manifest['occurrences']['removed_file'], dtype='str')
+        self.assertEqual([manifest['occurrences'][change] for change in ('added', 'changed', 'removed')], [1, 1, 1])
+        np.testing.assert_array_equal(changed.columns, self.current_occurrences.columns)
+        np.testing.assert_array_equal(changed['occurrenceID'].values, ['o2'])
+        np.testing.assert_array_equal(removed['occurrenceID'].values, ['o3'])
+
+    def test_failed_seas_are_not_removed(self):
+        previous_events = self.previous_events.assign(waterBody=['More', 'More', 'Ekofisk'])
+        current_events = self.current_events.iloc[:2].assign(waterBody='More')
+        with tempfile.TemporaryDirectory() as directory:
+            manifest = delta.publish_delta(previous_events, self.previous_occurrences, current_events, self.current_occurrences.iloc[:2], 'id', directory, failed_seas=['Ekofisk'])
+        self.assertEqual(manifest['failed_seas'], ['Ekofisk'])
+        self.assertEqual((manifest['events']['removed'], manifest['occurrences']['removed']), (0, 0))
+        self.assertEqual(manifest['occurrences']['previous'], 2)
+
+    def test_it_only_compares_against_the_same_years(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for years in ('2018', '2019', '2018-2019'):
+                for name in ('events', 'occurrences'):
+                    open(os.path.join(directory, 'dnv-' + name + '-' + years + '.csv'), 'w').close()
+            self.assertEqual(delta.published_paths(directory, '2019'), [[os.path.join(directory, 'dnv-events-2019.csv')], [os.path.join(directory, 'dnv-occurrences-2019.csv')]])
+
+    def test_everything_is_added_without_previous_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            previous_events, previous_occurrences = [delta.read_published(paths) for paths in delta.published_paths(directory, '2019')]
+            manifest = delta.publish_delta(previous_events, previous_occurrences, self.current_events, self.current_occurrences, 'id', directory)
+        self.assertEqual(manifest['occurrences']['added'], 3)
+        self.assertEqual(manifest['events']['added'], 3)
+
+
+class TestDwca(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.events = [pd.DataFrame({'eventID': [uuid.uuid4(), uuid.uuid4()], 'Station': ['A', 'B'], 'minimumDepthInMeters': [100, 120]}),
+                       pd.DataFrame({'eventID': [uuid.uuid4()], 'Station': ['C'], 'minimumDepthInMeters': [np.nan], 'locationRemarks': ['station C, with\ttab']})]
+        self.occurrences = [pd.DataFrame({'scientificName': pd.Categorical(['a', 'b', 'a']), 'individualCount': np.array([1, 2, 3], dtype='int32'), 'eventID': [self.events[0]['eventID'][i] for i in (0, 0, 1)]}),
+                            pd.DataFrame({'scientificName': pd.Categorical(['c']), 'individualCount': np.array([4], dtype='int32'), 'eventID': [self.events[1]['eventID'][0]]})]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_write_csv_matches_concatenated_frames(self):
+        dwca.write_csv(self.path('events.csv'), self.events, chunksize=1)
+        with open(self.path('events.csv')) as f:
+            self.assertEqual(f.read(), pd.concat(self.events).to_csv(index=False))
+        dwca.write_csv(self.path('occurrences.csv'), self.occurrences + [pd.DataFrame({'scientificName': ['d'], 'individualCount': [5.0], 'basisOfRecord': [None]})])
+        with open(self.path('occurrences.csv')) as f:
+            self.assertEqual(f.read(), pd.concat(self.occurrences + [pd.DataFrame({'scientificName': ['d'], 'individualCount': [5.0], 'basisOfRecord': [None]})]).to_csv(index=False))
+
+    def test_archive_has_event_core_and_occurrence_extension(self):
+        dwca.write_archive(self.path('dwca.zip'), self.events, self.occurrences, chunksize=2, title='Test')
+        with zipfile.ZipFile(self.path('dwca.zip')) as archive:
+            self.assertEqual(archive.namelist(), ['event.txt', 'occurrence.txt', 'meta.xml', 'eml.xml'])
+            events = pd.read_csv(archive.open('event.txt'), dtype='str')
+            occurrences = pd.read_csv(archive.open('occurrence.txt'), dtype='str')
+            meta = ElementTree.fromstring(archive.read('meta.xml'))
+            eml = ElementTree.fromstring(archive.read('eml.xml'))
+        np.testing.assert_array_equal(events.columns, ['eventID', 'Station', 'minimumDepthInMeters', 'locationRemarks'])
+        np.testing.assert_array_equal(events['locationRemarks'].fillna('').values, ['', '', 'station C, with\ttab'])
+        np.testing.assert_array_equal(occurrences['eventID'].values, [str(self.events[0]['eventID'][i]) for i in (0, 0, 1)] + [str(self.events[1]['eventID'][0])])
+        self.assertEqual(eml.find('dataset/title').text, 'Test')
+
+        namespace = {'text': 'http://rs.tdwg.org/dwc/text/'}
+        core, extension = meta.find('text:core', namespace), meta.find('text:extension', namespace)
+        self.assertEqual(core.find('text:files/text:location', namespace).text, 'event.txt')
+        self.assertEqual(core.find('text:id', namespace).get('index'), '0')
+        self.assertEqual(extension.find('text:coreid', namespace).get('index'), '2')
+        self.assertEqual([field.get('index') for field in core.findall('text:field', namespace)], ['0', '2', '3']) # Station is not a Darwin Core term
+        self.assertEqual(extension.findall('text:field', namespace)[1].get('term'), 'http://rs.tdwg.org/dwc/terms/individualCount')
+
+    def test_csv_copies_are_the_archive_entries(self):
+        dwca.write_archive(self.path('dwca.zip'), self.events, self.occurrences, chunksize=2, copies=(self.path('events.csv'), self.path('occurrences.csv')))
+        dwca.write_csv(self.path('expected.csv'), self.events, chunksize=2)
+        with zipfile.ZipFile(self.path('dwca.zip')) as archive, open(self.path('events.csv'), 'rb') as events, open(self.path('occurrences.csv'), 'rb') as occurrences, open(self.path('expected.csv'), 'rb') as expected:
+            self.assertEqual(events.read(), archive.read('event.txt'))
+            self.assertEqual(occurrences.read(), archive.read('occurrence.txt'))
+            self.assertEqual(archive.read('event.txt'), expected.read())
+
+    def test_failed_archive_leaves_no_file(self):
+        def failing_chunks():
+            yield b'eventID\n'
+            raise ValueError('formatting failed')
+        with self.assertRaises(ValueError):
+            dwca.write_atomically(self.path('dwca.zip'), lambda temporary: dwca.stream_archive(temporary, [('event.txt', failing_chunks())]))
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_parquet_keeps_numbers_and_writes_ids_as_text(self):
+        dwca.write_parquet(self.path('events.parquet'), self.events)
+        events = pd.read_parquet(self.path('events.parquet'))
+        self.assertEqual(events['minimumDepthInMeters'].dtype, float)
+        self.assertEqual(events['eventID'][0], str(self.events[0]['eventID'][0]))
+        self.assertTrue(pd.isnull(events['locationRemarks'][0]))
+        dwca.write_parquet(self.path('occurrences.parquet'), self.occurrences)
+        self.assertEqual(pd.read_parquet(self.path('occurrences.parquet'))['individualCount'].tolist(), [1, 2, 3, 4])
+
+
 if __name__ == '__main__':
     unittest.main()